@@ -0,0 +1,49 @@
+# Per-question setup cost of the answer chain: built for every question (as before the chain was
+# cached) vs. taken from the process-wide cache. No request is sent to the AI model.
+# Usage: python bench_chain_setup.py [--questions 200] [--fake-model]
+import os
+import time
+import argparse
+import statistics
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+import core
+
+def time_setup(build, questions):
+    """Milliseconds spent getting a chain, per question"""
+    samples = []
+    for _ in range(questions):
+        started = time.perf_counter()
+        build()
+        samples.append((time.perf_counter() - started) * 1000)
+    return samples
+
+def describe(samples):
+    return (f"mean {statistics.mean(samples):8.3f} ms  median {statistics.median(samples):8.3f} ms  "
+            f"max {max(samples):8.3f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the per-question setup of the answer chain")
+    parser.add_argument("--questions", type=int, default=200)
+    parser.add_argument("--fake-model", action="store_true",
+                        help="Use a fake chat model instead of constructing the Gemini client")
+    args = parser.parse_args()
+    
+    if args.fake_model:
+        core.ChatGoogleGenerativeAI = lambda **kwargs: FakeListChatModel(responses=["ok"])
+    else:
+        # The client is only constructed, never called, so any key will do
+        os.environ.setdefault("GOOGLE_API_KEY", "benchmark")
+    
+    uncached = time_setup(core.get_answer_chain.__wrapped__, args.questions)
+    core.get_answer_chain.clear()
+    first = time_setup(core.get_answer_chain, 1)
+    cached = time_setup(core.get_answer_chain, args.questions)
+    
+    model = "fake chat model" if args.fake_model else "Gemini client"
+    print(f"Answer chain setup with the {model}, {args.questions} questions")
+    print(f"  built per question: {describe(uncached)}")
+    print(f"  cached, first call: {first[0]:8.3f} ms")
+    print(f"  cached, later:      {describe(cached)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+# Full-page vs. fragment rerun times of the chat actions (Listen, Export) and the feedback radio.
+# Drives new.py with Streamlit's AppTest against local embeddings and a pre-filled speech cache,
+# so no request leaves the machine. AppTest always reruns the whole script, so a fragment rerun
+# is estimated by the time spent inside the fragment (st.session_state.script_times).
+# Usage: python bench_fragments.py [--turns 20] [--repeats 20]
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "new.py")
+
+def median_ms(samples):
+    return statistics.median(samples) * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description="Time full-page vs. fragment reruns of new.py")
+    parser.add_argument("--turns", type=int, default=20, help="Chat turns on the page")
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+    
+    # The model is never called and the answer audio comes from the cache
+    os.environ.setdefault("GOOGLE_API_KEY", "benchmark")
+    os.environ.setdefault("EMBEDDING_BACKEND", "hashing")
+    os.environ["TTS_CACHE_DIR"] = tempfile.mkdtemp(prefix="bench_tts_")
+    os.environ["CHAT_SPILL_DIR"] = tempfile.mkdtemp(prefix="bench_chat_")
+    sys.path.insert(0, os.path.dirname(SCRIPT))
+    from streamlit.testing.v1 import AppTest
+    from speech import SpeechSynthesizer
+    
+    app = AppTest.from_file(SCRIPT, default_timeout=60)
+    app.run()
+    for turn in range(args.turns):
+        app.session_state["chat_history"].append((f"Question {turn}?", f"Answer {turn}. " * 80, ""))
+    answer = app.session_state["chat_history"][-1][1]
+    audio_path = os.path.join(os.environ["TTS_CACHE_DIR"], SpeechSynthesizer.cache_key(answer, "en") + ".mp3")
+    with open(audio_path, "wb") as f:
+        f.write(b"ID3")
+    app.run()
+    
+    def click(label):
+        return lambda repeat: next(b for b in app.button if b.label == label).click()
+    
+    def choose_feedback(repeat):
+        # Alternate the choice so every rerun sees a changed value
+        radio = app.radio[0]
+        return radio.set_value(radio.options[repeat % len(radio.options)])
+    
+    interactions = {
+        "Listen": ("actions", click("🔊 Listen")),
+        "Export": ("actions", click("💾 Export")),
+        "Feedback": ("feedback", choose_feedback),
+    }
+    print(f"new.py with {args.turns} chat turns, median of {args.repeats} interactions")
+    print(f"  {'interaction':<10} {'full page':>10} {'fragment':>10} {'AppTest round trip':>20}")
+    for name, (section, interact) in interactions.items():
+        full_page, fragment, round_trip = [], [], []
+        for repeat in range(args.repeats):
+            widget = interact(repeat)
+            started = time.perf_counter()
+            widget.run()
+            round_trip.append(time.perf_counter() - started)
+            if app.exception:
+                raise SystemExit(f"new.py raised: {app.exception[0].value}")
+            times = app.session_state["script_times"]
+            full_page.append(times["full page"])
+            fragment.append(times[section])
+        print(f"  {name:<10} {median_ms(full_page):8.2f} ms {median_ms(fragment):8.2f} ms "
+              f"{median_ms(round_trip):18.2f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2255 @@
+# Headless document ingestion and question answering: PDF extraction, indexing, retrieval and answers.
+# Shared by the Streamlit app (new.py) and the HTTP service (service.py); nothing here uses Streamlit.
+import os
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_google_genai import GoogleGenerativeAIEmbeddings, ChatGoogleGenerativeAI
+from langchain_core.embeddings import Embeddings
+from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.base import Docstore, AddableMixin
+from langchain_core.documents import Document
+import faiss
+import numpy as np
+from langchain.chains.question_answering import load_qa_chain
+from langchain.prompts import PromptTemplate
+from langchain_core.prompts import format_document
+from dotenv import load_dotenv
+import tempfile
+import hashlib
+import io
+import functools
+import threading
+import shutil
+import time
+import random
+import sqlite3
+import unicodedata
+import json
+import bisect
+import math
+import heapq
+import mmap
+import pickle
+import re
+from array import array
+from collections import OrderedDict, deque
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from pdf_extraction import count_pages, extract_page_range
+from qa_api import AnswerStream, IngestionError, EmbeddingError
+
+# Load environment variables
+load_dotenv()
+
+# Text splitting parameters (also part of the ingestion cache key)
+CHUNK_SIZE = 1500  # Smaller chunks for better precision
+CHUNK_OVERLAP = 300  # More overlap for better context preservation
+SPLITTER_SEPARATORS = ["\n\n", "\n", ". ", " ", ""]  # Better separation logic
+MIN_CHUNK_LENGTH = 50
+INDEX_FORMAT_VERSION = 4  # Bump when the on-disk index layout changes, so old indexes aren't reused
+
+# PDF extraction settings
+EXTRACTION_MAX_WORKERS = int(os.getenv("EXTRACTION_MAX_WORKERS", str(os.cpu_count() or 1)))
+EXTRACTION_PAGES_PER_TASK = 16
+PARALLEL_EXTRACTION_MIN_PAGES = 32  # Smaller uploads aren't worth the process start-up cost
+EXTRACTION_PREFETCH_TASKS = 2 * max(1, EXTRACTION_MAX_WORKERS)  # Page ranges parsed ahead of the splitter
+
+# Vector store locations and budgets
+INDEX_STORE_ROOT = os.getenv("INDEX_STORE_ROOT", "faiss_indexes")  # One sub-directory per corpus
+INDEX_STORE_MAX_BYTES = int(os.getenv("INDEX_STORE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+INDEX_REF_TTL_SECONDS = 6 * 60 * 60  # Sessions that stop touching an index release it after this
+INDEX_REGISTRY_MAX_BYTES = int(os.getenv("INDEX_REGISTRY_MAX_BYTES", str(512 * 1024 * 1024)))
+
+# Vector index type: "auto" picks by chunk count; "flat", "ivf_flat", "hnsw" or "ivf_pq" force one
+ANN_INDEX_TYPE = os.getenv("ANN_INDEX_TYPE", "auto").lower()
+FLAT_INDEX_MAX_VECTORS = 50_000  # Exact search stays fast enough below this
+HNSW_INDEX_MAX_VECTORS = 500_000
+IVF_FLAT_INDEX_MAX_VECTORS = 2_000_000  # Beyond this, vectors are compressed with product quantization
+ANN_MIN_TRAIN_VECTORS = 1000  # Smaller corpora always use the flat index
+ANN_TRAIN_POINTS_PER_LIST = 64
+IVF_NPROBE = int(os.getenv("IVF_NPROBE", "16"))
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 80
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "64"))
+ANN_ADD_BATCH_SIZE = 65536  # Vectors read from disk into the new index per step
+ANN_RECALL_QUERIES = 200
+SCOPED_EXACT_SEARCH_MAX_VECTORS = 50_000  # Smaller search scopes skip the ANN index and are searched exactly
+
+# Embedding backend: "google", "sentence-transformers", "tfidf" or "hashing" (the last three run locally on CPU)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "google").lower()
+EMBEDDING_MODEL = "models/embedding-001"
+LOCAL_EMBEDDING_MODEL = os.getenv("LOCAL_EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+HASHING_EMBEDDING_DIM = int(os.getenv("HASHING_EMBEDDING_DIM", "768"))
+VECTORIZER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "vectorizer.pkl")
+
+# Retrieval settings
+NUM_CONTEXT_DOCS = 6  # Get more documents for better context
+NUM_FALLBACK_DOCS = 10  # Wider net for the "not available" fallback
+BM25_K1 = 1.2
+BM25_B = 0.75
+RRF_K = 60  # Reciprocal rank fusion damping constant
+
+# Optional reranking: "none", "lexical", "tfidf" (bundled vectorizer and classifier) or "cross-encoder"
+RERANKER = os.getenv("RERANKER", "none").lower()
+RERANK_CANDIDATES = 50  # Retrieved for the reranker to score
+RERANK_TOP_K = 4  # Kept for the AI model
+RERANK_TIMEOUT_SECONDS = float(os.getenv("RERANK_TIMEOUT_SECONDS", "1.5"))  # Fused order is used past this
+RERANKER_MODEL = os.getenv("RERANKER_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+CLASSIFIER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "classifier.pkl")
+CLASS_AGREEMENT_WEIGHT = 0.2  # tfidf reranker bonus for chunks of the document type the question is about
+
+# Context packing: chunks sent to the AI model are picked by MMR under a token budget
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "2500"))
+CHARS_PER_TOKEN = 4  # Rough average for Gemini tokenizers on English text
+MMR_LAMBDA = 0.7  # 1.0 ranks by relevance only, lower values favour diversity
+NEAR_DUPLICATE_SIMILARITY = 0.95  # Chunks this similar to one already picked are dropped
+
+# "not available" fallback: "sequential" retries after the first answer; "speculative" starts the
+# broadened answer alongside it whenever the best match is weaker than the similarity threshold.
+# The threshold is not calibrated per embedding backend, so speculation is opt-in
+FALLBACK_STRATEGY = os.getenv("FALLBACK_STRATEGY", "sequential").lower()
+SPECULATIVE_FALLBACK_SIMILARITY = float(os.getenv("SPECULATIVE_FALLBACK_SIMILARITY", "0.7"))
+ANSWER_MAX_WORKERS = 8
+
+# Query embedding and answer caches
+QUERY_CACHE_SIZE = 1024
+QUERY_CACHE_TTL_SECONDS = 60 * 60
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+ANSWER_CACHE_SIZE = 256
+ANSWER_CACHE_TTL_SECONDS = 24 * 60 * 60
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))  # Cosine threshold for reuse
+
+# Embedding pipeline settings
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+EMBEDDING_MAX_WORKERS = int(os.getenv("EMBEDDING_MAX_WORKERS", "4"))
+EMBEDDING_REQUESTS_PER_MINUTE = float(os.getenv("EMBEDDING_REQUESTS_PER_MINUTE", "120"))
+EMBEDDING_MAX_RETRIES = 5
+EMBEDDING_RETRY_BASE_DELAY = 1.0  # Seconds, doubled on every retry
+EMBEDDING_MAX_PENDING_BATCHES = 2 * EMBEDDING_MAX_WORKERS  # Batches held in memory before reading more chunks
+
+# Persistent chunk embedding cache
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.sqlite3")
+EMBEDDING_CACHE_MAX_BYTES = int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+
+def process_resource(function):
+    """Cache a function's result per arguments for the life of the process, like st.cache_resource"""
+    lock = threading.Lock()
+    results = {}
+    
+    @functools.wraps(function)
+    def cached(*args):
+        with lock:
+            if args not in results:
+                results[args] = function(*args)
+            return results[args]
+    
+    def clear():
+        with lock:
+            results.clear()
+    
+    cached.clear = clear
+    return cached
+
+@process_resource
+def get_extraction_pool():
+    """Return the process-wide pool used to parse PDF pages in parallel, or None if unsupported"""
+    if EXTRACTION_MAX_WORKERS < 2:
+        return None
+    # The calling process is multi-threaded (web server, embedding pools, gRPC channels), so forking
+    # it can deadlock the children; fresh workers only need to import pdf_extraction.py
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["pdf_extraction"])
+    else:
+        context = multiprocessing.get_context("spawn")
+    return ProcessPoolExecutor(max_workers=EXTRACTION_MAX_WORKERS, mp_context=context)
+
+def iter_pdf_pages(keyed_files, temp_dir):
+    """Yield (file key, file name, page number, page text) for every page, in order
+
+    Page ranges are parsed ahead on the extraction pool, but never more than
+    EXTRACTION_PREFETCH_TASKS ranges at a time, so memory doesn't grow with the upload.
+    """
+    # Worker processes read the PDFs from disk instead of receiving the bytes with every task
+    tasks = []
+    for file_idx, (file_key, file) in enumerate(keyed_files):
+        path = os.path.join(temp_dir, f"{file_idx}.pdf")
+        with open(path, "wb") as pdf_file:
+            pdf_file.write(file.getvalue())
+        try:
+            page_count = count_pages(path)
+        except Exception as file_error:
+            continue
+        tasks.extend((file_key, file.name, path, start, min(start + EXTRACTION_PAGES_PER_TASK, page_count))
+                     for start in range(0, page_count, EXTRACTION_PAGES_PER_TASK))
+    
+    total_pages = sum(stop - start for _, _, _, start, stop in tasks)
+    pool = get_extraction_pool() if total_pages >= PARALLEL_EXTRACTION_MIN_PAGES else None
+    pending = deque()
+    remaining = iter(tasks)
+    
+    while True:
+        while len(pending) < EXTRACTION_PREFETCH_TASKS:
+            task = next(remaining, None)
+            if task is None:
+                break
+            future = None
+            if pool is not None:
+                try:
+                    future = pool.submit(extract_page_range, *task[2:])
+                except BrokenProcessPool:
+                    pool = None
+                    get_extraction_pool.clear()
+            pending.append((task, future))
+        
+        if not pending:
+            return
+        
+        (file_key, file_name, path, start, stop), future = pending.popleft()
+        try:
+            texts = future.result() if future is not None else extract_page_range(path, start, stop)
+        except BrokenProcessPool:
+            # A worker died (e.g. out of memory); start a fresh pool next time and finish in-process
+            if pool is not None:
+                pool = None
+                get_extraction_pool.clear()
+            texts = extract_page_range(path, start, stop)
+        
+        for offset, page_text in enumerate(texts):
+            yield file_key, file_name, start + offset, page_text
+
+class UploadedPDF(io.BytesIO):
+    """A PDF held in memory under a file name, interchangeable with Streamlit's uploaded files"""
+    
+    def __init__(self, name, data):
+        super().__init__(data)
+        self.name = name
+
+def file_fingerprint(file):
+    """Return a SHA-256 hash of an uploaded file's content"""
+    file.seek(0)
+    digest = hashlib.sha256(file.getvalue()).hexdigest()
+    file.seek(0)
+    return digest
+
+def compute_file_key(file):
+    """Identify an uploaded file by its name and content"""
+    # File names end up in the page markers, so they are part of the key too
+    return hashlib.sha256(f"{file.name}:{file_fingerprint(file)}".encode("utf-8")).hexdigest()[:32]
+
+def compute_ingestion_key(files):
+    """Build a cache key from the set of uploaded files and the text splitting parameters"""
+    hasher = hashlib.sha256()
+    for file_key in sorted(compute_file_key(file) for file in files):
+        hasher.update(f"{file_key}\n".encode("utf-8"))
+    hasher.update(f"{CHUNK_SIZE}:{CHUNK_OVERLAP}:{SPLITTER_SEPARATORS!r}:{MIN_CHUNK_LENGTH}".encode("utf-8"))
+    hasher.update(f"v{INDEX_FORMAT_VERSION}:{embedding_model_name()}".encode("utf-8"))
+    return hasher.hexdigest()
+
+def chunk_id(file_key, position):
+    """Docstore ID of a file's chunk, so a file's vectors can be found again without a lookup table"""
+    return f"{file_key}-{position}"
+
+def preprocess_text(text):
+    # Improved text preprocessing
+    # Remove extra whitespace but preserve paragraph breaks
+    text = re.sub(r'\n\s*\n', '\n\n', text)  # Normalize paragraph breaks
+    text = re.sub(r'[ \t]+', ' ', text)  # Normalize spaces and tabs
+    text = text.strip()
+    return text
+
+TOKEN_PATTERN = re.compile(r"(?u)\b\w\w+\b")  # Same tokenization as the bundled TfidfVectorizer
+
+class HashingEmbeddings(Embeddings):
+    """Local embeddings from signed feature hashing of word unigrams and bigrams"""
+    
+    def __init__(self, dim=HASHING_EMBEDDING_DIM):
+        self.dim = dim
+    
+    def _embed(self, text):
+        vector = np.zeros(self.dim, dtype="float32")
+        tokens = TOKEN_PATTERN.findall(text.lower())
+        counts = {}
+        for feature in tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]:
+            counts[feature] = counts.get(feature, 0) + 1
+        for feature, count in counts.items():
+            digest = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+            sign = 1.0 if digest & 1 else -1.0
+            vector[(digest >> 1) % self.dim] += sign * (1.0 + math.log(count))  # Sublinear term frequency
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+    
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+    
+    def embed_query(self, text):
+        return self._embed(text)
+
+class TfidfEmbeddings(Embeddings):
+    """Local embeddings from the bundled TF-IDF vectorizer (requires scikit-learn)
+
+    The bundled vocabulary has only 39 terms, so most chunks and questions embed to zero or
+    near-zero vectors and retrieval is close to random. Use "hashing" or "sentence-transformers"
+    for offline retrieval; this backend is only useful with a vectorizer fit on your own documents.
+    """
+    
+    def __init__(self, vectorizer_path=VECTORIZER_PATH):
+        # The pickle ships with this repository, so it is trusted
+        with open(vectorizer_path, "rb") as vectorizer_file:
+            self.vectorizer = pickle.load(vectorizer_file)
+    
+    def embed_documents(self, texts):
+        return self.vectorizer.transform(texts).toarray().astype("float32").tolist()
+    
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+class SentenceTransformerEmbeddings(Embeddings):
+    """Local embeddings from a small sentence-transformers model (requires sentence-transformers)"""
+    
+    def __init__(self, model_name=LOCAL_EMBEDDING_MODEL):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name, device="cpu")
+    
+    def embed_documents(self, texts):
+        return self.model.encode(list(texts), batch_size=32, normalize_embeddings=True).tolist()
+    
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+def make_google_embeddings():
+    return GoogleGenerativeAIEmbeddings(
+        model=EMBEDDING_MODEL,
+        google_api_key=os.getenv("GOOGLE_API_KEY")
+    )
+
+# Backend name -> (factory, whether it calls a remote API)
+EMBEDDING_BACKENDS = {
+    "google": (make_google_embeddings, True),
+    "sentence-transformers": (SentenceTransformerEmbeddings, False),
+    "tfidf": (TfidfEmbeddings, False),
+    "hashing": (HashingEmbeddings, False),
+}
+
+def embedding_model_name(backend=EMBEDDING_BACKEND):
+    """Identify the embedding model, so vectors from different models are never mixed"""
+    if backend == "google":
+        return EMBEDDING_MODEL
+    if backend == "sentence-transformers":
+        return f"sentence-transformers:{LOCAL_EMBEDDING_MODEL}"
+    if backend == "tfidf":
+        with open(VECTORIZER_PATH, "rb") as vectorizer_file:
+            return f"tfidf:{hashlib.sha256(vectorizer_file.read()).hexdigest()[:16]}"
+    return f"hashing:{HASHING_EMBEDDING_DIM}"
+
+@process_resource
+def get_embeddings(backend=EMBEDDING_BACKEND):
+    """Return the process-wide embeddings client for the configured backend"""
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown embedding backend '{backend}'. Choose one of: {', '.join(EMBEDDING_BACKENDS)}")
+    factory, _ = EMBEDDING_BACKENDS[backend]
+    return factory()
+
+class ChunkTable:
+    """Columnar chunk metadata (file, pages, character offsets) kept beside the FAISS docstore
+
+    Chunks of one file are stored in contiguous rows in page order, so file and page
+    filters are answered by bisecting each file's page columns instead of scanning.
+    """
+    
+    COLUMNS = ("file", "page_start", "page_end", "char_start", "char_end")
+    
+    def __init__(self):
+        self.file_keys = []  # Values of the file column index into these two lists
+        self.file_names = []
+        self.chunk_ids = []
+        self.file = array("I")
+        self.page_start = array("I")
+        self.page_end = array("I")
+        self.char_start = array("Q")
+        self.char_end = array("Q")
+        self._rows = None
+        self._file_ranges = None
+    
+    def __len__(self):
+        return len(self.chunk_ids)
+    
+    def append(self, chunk_id, file_key, file_name, page_start, page_end, char_start, char_end):
+        if not self.file_keys or self.file_keys[-1] != file_key:
+            self.file_keys.append(file_key)
+            self.file_names.append(file_name)
+        self.chunk_ids.append(chunk_id)
+        self.file.append(len(self.file_keys) - 1)
+        self.page_start.append(page_start)
+        self.page_end.append(page_end)
+        self.char_start.append(char_start)
+        self.char_end.append(char_end)
+        self._rows = self._file_ranges = None
+    
+    def remove_files(self, file_keys):
+        """Drop every row belonging to the given files"""
+        removed = {self.file_keys.index(key) for key in file_keys if key in self.file_keys}
+        if not removed:
+            return
+        kept = [row for row in range(len(self)) if self.file[row] not in removed]
+        remap = {}
+        for old_index, key in enumerate(self.file_keys):
+            if old_index not in removed:
+                remap[old_index] = len(remap)
+        
+        self.chunk_ids = [self.chunk_ids[row] for row in kept]
+        self.file = array("I", (remap[self.file[row]] for row in kept))
+        for column in self.COLUMNS[1:]:
+            values = getattr(self, column)
+            setattr(self, column, array(values.typecode, (values[row] for row in kept)))
+        self.file_keys = [key for index, key in enumerate(self.file_keys) if index not in removed]
+        self.file_names = [name for index, name in enumerate(self.file_names) if index not in removed]
+        self._rows = self._file_ranges = None
+    
+    def row(self, chunk_id):
+        if self._rows is None:
+            self._rows = {cid: row for row, cid in enumerate(self.chunk_ids)}
+        return self._rows.get(chunk_id)
+    
+    def rows_for(self, file_keys=None, page_range=None):
+        """Rows of chunks in the given files that overlap the inclusive (first, last) page range"""
+        if self._file_ranges is None:
+            self._file_ranges = {}
+            for row, file_index in enumerate(self.file):
+                lo, _ = self._file_ranges.get(file_index, (row, row))
+                self._file_ranges[file_index] = (lo, row + 1)
+        
+        if file_keys is None:
+            file_indexes = list(self._file_ranges)
+        else:
+            file_indexes = [self.file_keys.index(key) for key in file_keys if key in self.file_keys]
+        
+        rows = []
+        for file_index in file_indexes:
+            lo, hi = self._file_ranges.get(file_index, (0, 0))
+            if page_range is not None:
+                first_page, last_page = page_range
+                # Both page columns are non-decreasing within a file
+                lo, hi = (bisect.bisect_left(self.page_end, first_page, lo, hi),
+                          bisect.bisect_right(self.page_start, last_page, lo, hi))
+            rows.extend(range(lo, hi))
+        return rows
+    
+    def max_page(self):
+        return max(self.page_end, default=0)
+    
+    def save(self, path):
+        data = {"file_keys": self.file_keys, "file_names": self.file_names, "chunk_ids": self.chunk_ids}
+        data.update({column: getattr(self, column).tolist() for column in self.COLUMNS})
+        with open(path, "w", encoding="utf-8") as table_file:
+            json.dump(data, table_file)
+    
+    @classmethod
+    def load(cls, path):
+        table = cls()
+        with open(path, encoding="utf-8") as table_file:
+            data = json.load(table_file)
+        table.file_keys = data["file_keys"]
+        table.file_names = data["file_names"]
+        table.chunk_ids = data["chunk_ids"]
+        for column in cls.COLUMNS:
+            setattr(table, column, array(getattr(table, column).typecode, data[column]))
+        return table
+
+LEXICAL_TOKEN_PATTERN = re.compile(r"(?u)\b\w+\b")  # Unlike TOKEN_PATTERN, keeps one-character IDs and digits
+
+def lexical_tokens(text):
+    return LEXICAL_TOKEN_PATTERN.findall(text.lower())
+
+class BM25Segment:
+    """Inverted index over one file's chunks; row r is that file's chunk at position r
+
+    Postings are stored in two flat arrays (chunk rows and term frequencies), and each
+    term maps to its (start, end) slice of them.
+    """
+    
+    def __init__(self, terms, rows, freqs, lengths):
+        self.terms = terms
+        self.rows = rows
+        self.freqs = freqs
+        self.lengths = lengths
+    
+    @classmethod
+    def build(cls, texts):
+        builder = BM25SegmentBuilder()
+        for row, text in enumerate(texts):
+            builder.add(row, text)
+        return builder.finish()
+    
+    def doc_freq(self, term):
+        start, end = self.terms.get(term, (0, 0))
+        return end - start
+    
+    def nbytes(self):
+        return self.rows.nbytes + self.freqs.nbytes + self.lengths.nbytes + 48 * len(self.terms)
+
+class BM25SegmentBuilder:
+    """Collects a file's postings as its chunks stream past, without keeping the chunk texts"""
+    
+    def __init__(self):
+        self._postings = {}  # term -> (rows, term frequencies)
+        self._lengths = array("i")
+    
+    def add(self, row, text):
+        """Add the chunk at the next row (rows are added in order, starting at 0)"""
+        if row != len(self._lengths):
+            raise ValueError(f"Expected row {len(self._lengths)}, got {row}")
+        tokens = lexical_tokens(text)
+        self._lengths.append(len(tokens))
+        counts = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for token, count in counts.items():
+            rows, freqs = self._postings.setdefault(token, (array("i"), array("i")))
+            rows.append(row)
+            freqs.append(count)
+    
+    def finish(self):
+        terms = {}
+        rows = array("i")
+        freqs = array("i")
+        for term, (term_rows, term_freqs) in self._postings.items():
+            terms[term] = (len(rows), len(rows) + len(term_rows))
+            rows.extend(term_rows)
+            freqs.extend(term_freqs)
+        return BM25Segment(terms, np.array(rows, dtype="int32"), np.array(freqs, dtype="int32"),
+                           np.array(self._lengths, dtype="int32"))
+
+class BM25Index:
+    """BM25 lexical index made of one segment per file, so files can be added and dropped cheaply"""
+    
+    def __init__(self):
+        self.segments = OrderedDict()  # file key -> BM25Segment
+    
+    def add_file(self, file_key, texts):
+        self.add_segment(file_key, BM25Segment.build(texts))
+    
+    def add_segment(self, file_key, segment):
+        self.segments[file_key] = segment
+    
+    def remove_files(self, file_keys):
+        for file_key in file_keys:
+            self.segments.pop(file_key, None)
+    
+    def search(self, query, k, allowed_ids=None):
+        """Return the chunk IDs of the k best BM25 matches, best first"""
+        terms = set(lexical_tokens(query))
+        doc_count = sum(len(segment.lengths) for segment in self.segments.values())
+        if not terms or not doc_count:
+            return []
+        avg_length = max(1.0, sum(int(segment.lengths.sum()) for segment in self.segments.values()) / doc_count)
+        
+        idf = {}
+        for term in terms:
+            doc_freq = sum(segment.doc_freq(term) for segment in self.segments.values())
+            if doc_freq:
+                idf[term] = math.log(1 + (doc_count - doc_freq + 0.5) / (doc_freq + 0.5))
+        
+        scored = []
+        for file_key, segment in self.segments.items():
+            scores = np.zeros(len(segment.lengths), dtype="float32")
+            for term, term_idf in idf.items():
+                if term not in segment.terms:
+                    continue
+                start, end = segment.terms[term]
+                rows = segment.rows[start:end]
+                freqs = segment.freqs[start:end].astype("float32")
+                length_norm = 1 - BM25_B + BM25_B * segment.lengths[rows] / avg_length
+                scores[rows] += term_idf * freqs * (BM25_K1 + 1) / (freqs + BM25_K1 * length_norm)
+            for row in np.nonzero(scores)[0]:
+                cid = chunk_id(file_key, int(row))
+                if allowed_ids is None or cid in allowed_ids:
+                    scored.append((float(scores[row]), cid))
+        return [cid for _, cid in heapq.nlargest(k, scored)]
+    
+    def nbytes(self):
+        return sum(segment.nbytes() for segment in self.segments.values())
+    
+    def save(self, directory):
+        file_keys = list(self.segments)
+        with open(os.path.join(directory, "bm25.json"), "w", encoding="utf-8") as terms_file:
+            json.dump({"file_keys": file_keys,
+                       "terms": [self.segments[file_key].terms for file_key in file_keys]}, terms_file)
+        arrays = {}
+        for number, file_key in enumerate(file_keys):
+            segment = self.segments[file_key]
+            arrays[f"rows_{number}"] = segment.rows
+            arrays[f"freqs_{number}"] = segment.freqs
+            arrays[f"lengths_{number}"] = segment.lengths
+        np.savez(os.path.join(directory, "bm25.npz"), **arrays)
+    
+    @classmethod
+    def load(cls, directory):
+        index = cls()
+        with open(os.path.join(directory, "bm25.json"), encoding="utf-8") as terms_file:
+            data = json.load(terms_file)
+        with np.load(os.path.join(directory, "bm25.npz")) as arrays:
+            for number, (file_key, terms) in enumerate(zip(data["file_keys"], data["terms"])):
+                index.segments[file_key] = BM25Segment(
+                    {term: tuple(bounds) for term, bounds in terms.items()},
+                    arrays[f"rows_{number}"], arrays[f"freqs_{number}"], arrays[f"lengths_{number}"]
+                )
+        return index
+
+class LoadedIndex:
+    """A FAISS vector store together with its chunk metadata table and BM25 index"""
+    
+    def __init__(self, vector_store, chunk_table, lexical_index):
+        self.vector_store = vector_store
+        self.chunk_table = chunk_table
+        self.lexical_index = lexical_index
+        self._positions = None
+        if isinstance(vector_store.index, faiss.IndexIVF):
+            # IVF indexes can only reconstruct stored vectors through a position -> list map
+            vector_store.index.make_direct_map()
+    
+    def positions_for(self, chunk_ids):
+        """FAISS positions of the given docstore chunk IDs"""
+        if self._positions is None:
+            self._positions = {cid: position for position, cid in self.vector_store.index_to_docstore_id.items()}
+        return [self._positions[cid] for cid in chunk_ids if cid in self._positions]
+    
+    def vectors_for(self, chunk_ids):
+        """Stored vectors of the given chunk IDs (approximate for product-quantized indexes)"""
+        positions = np.array(self.positions_for(chunk_ids), dtype="int64")
+        return self.vector_store.index.reconstruct_batch(positions)
+
+class MappedDocstore(Docstore):
+    """Read-only docstore over a flat chunk text file, sliced by an array of byte offsets
+
+    The file is memory-mapped, so every process serving the same index shares one copy
+    in the page cache and opening it reads nothing up front.
+    """
+    
+    def __init__(self, directory, chunk_ids):
+        self._positions = {cid: position for position, cid in enumerate(chunk_ids)}
+        self._offsets = np.load(os.path.join(directory, "texts.offsets.npy"), mmap_mode="r")
+        with open(os.path.join(directory, "texts.bin"), "rb") as text_file:
+            self._texts = mmap.mmap(text_file.fileno(), 0, access=mmap.ACCESS_READ)
+    
+    def search(self, search):
+        position = self._positions.get(search)
+        if position is None:
+            return f"ID {search} not found."
+        start, end = self._offsets[position], self._offsets[position + 1]
+        return Document(page_content=self._texts[start:end].decode("utf-8"))
+
+class TextSpill(Docstore, AddableMixin):
+    """Append-only chunk text file that stands in for the docstore while an index is built
+
+    Texts are written in the flat format save_vector_store publishes, so a build keeps only
+    offsets in memory and publishing copies the file instead of re-encoding every chunk.
+    """
+    
+    def __init__(self, directory):
+        self.path = os.path.join(directory, "texts.bin")
+        self._offsets = array("q", [0])
+        self._positions = {}  # chunk ID -> position in the file
+        open(self.path, "wb").close()
+    
+    @classmethod
+    def copy_of(cls, index_path, chunk_ids, directory):
+        """Start from the chunk texts of a published index"""
+        spill = cls(directory)
+        shutil.copyfile(os.path.join(index_path, "texts.bin"), spill.path)
+        spill._offsets = array("q", np.load(os.path.join(index_path, "texts.offsets.npy")).tobytes())
+        spill._positions = {cid: position for position, cid in enumerate(chunk_ids)}
+        return spill
+    
+    def add(self, texts):
+        with open(self.path, "ab") as text_file:
+            for cid, doc in texts.items():
+                data = doc.page_content.encode("utf-8")
+                text_file.write(data)
+                self._positions[cid] = len(self._offsets) - 1
+                self._offsets.append(self._offsets[-1] + len(data))
+    
+    def delete(self, ids):
+        # Deleted texts stay in the file; save writes only the chunks still in the index
+        for cid in ids:
+            del self._positions[cid]
+    
+    def search(self, search):
+        position = self._positions.get(search)
+        if position is None:
+            return f"ID {search} not found."
+        start, end = self._offsets[position], self._offsets[position + 1]
+        with open(self.path, "rb") as text_file:
+            text_file.seek(start)
+            return Document(page_content=text_file.read(end - start).decode("utf-8"))
+    
+    def save(self, directory, chunk_ids):
+        """Write the texts of the given chunks, in that order, as texts.bin and texts.offsets.npy"""
+        text_path = os.path.join(directory, "texts.bin")
+        if len(chunk_ids) == len(self._offsets) - 1 and all(
+                self._positions.get(cid) == position for position, cid in enumerate(chunk_ids)):
+            # Nothing was deleted or reordered: the spill file is already the published file
+            shutil.copyfile(self.path, text_path)
+            offsets = self._offsets
+        else:
+            offsets = array("q", [0])
+            with open(self.path, "rb") as spill_file, open(text_path, "wb") as text_file:
+                for cid in chunk_ids:
+                    position = self._positions[cid]
+                    start, end = self._offsets[position], self._offsets[position + 1]
+                    spill_file.seek(start)
+                    text_file.write(spill_file.read(end - start))
+                    offsets.append(offsets[-1] + end - start)
+        np.save(os.path.join(directory, "texts.offsets.npy"), np.frombuffer(offsets, dtype="int64"))
+
+def save_vector_store(vector_store, directory):
+    """Write the FAISS index, the chunk IDs in index order and the chunk texts as one flat file"""
+    faiss.write_index(vector_store.index, os.path.join(directory, "index.faiss"))
+    chunk_ids = [vector_store.index_to_docstore_id[position] for position in range(vector_store.index.ntotal)]
+    with open(os.path.join(directory, "chunk_ids.json"), "w", encoding="utf-8") as ids_file:
+        json.dump(chunk_ids, ids_file)
+    
+    if isinstance(vector_store.docstore, TextSpill):
+        vector_store.docstore.save(directory, chunk_ids)
+        return
+    offsets = array("q", [0])
+    with open(os.path.join(directory, "texts.bin"), "wb") as text_file:
+        for cid in chunk_ids:
+            data = vector_store.docstore.search(cid).page_content.encode("utf-8")
+            text_file.write(data)
+            offsets.append(offsets[-1] + len(data))
+    np.save(os.path.join(directory, "texts.offsets.npy"), np.array(offsets, dtype="int64"))
+
+def load_index(index_path, embeddings, spill_dir=None):
+    """Open a published vector store, its chunk table and BM25 index from disk
+
+    By default the index is memory-mapped and read-only; pass spill_dir for a private copy
+    that can be modified, with its chunk texts copied to a TextSpill in that directory.
+    """
+    # IVF inverted lists are mapped rather than read; other index types are read in full
+    io_flags = faiss.IO_FLAG_MMAP if spill_dir is None else 0
+    index = faiss.read_index(os.path.join(index_path, "index.faiss"), io_flags)
+    with open(os.path.join(index_path, "chunk_ids.json"), encoding="utf-8") as ids_file:
+        chunk_ids = json.load(ids_file)
+    if spill_dir is None:
+        docstore = MappedDocstore(index_path, chunk_ids)
+    else:
+        docstore = TextSpill.copy_of(index_path, chunk_ids, spill_dir)
+    vector_store = FAISS(embeddings, index, docstore, dict(enumerate(chunk_ids)))
+    
+    chunk_table = ChunkTable.load(os.path.join(index_path, "chunks.json"))
+    lexical_index = BM25Index.load(index_path)
+    return LoadedIndex(vector_store, chunk_table, lexical_index)
+
+def index_version(index_path):
+    """Identify a saved index build by the modification time of its files"""
+    index_file = os.path.join(index_path, "index.faiss")
+    texts_file = os.path.join(index_path, "texts.bin")
+    return (os.stat(index_file).st_mtime_ns, os.stat(texts_file).st_mtime_ns)
+
+def vector_index_bytes(index):
+    """Rough in-memory footprint of a FAISS index of any supported type"""
+    if isinstance(index, faiss.IndexIVF):
+        # Codes plus a 64-bit ID per vector, and the coarse centroids
+        return index.ntotal * (index.code_size + 8) + index.nlist * index.d * 4
+    if isinstance(index, faiss.IndexHNSW):
+        # Full vectors plus the level-0 neighbour lists, which dominate the graph
+        return index.ntotal * (index.d * 4 + 2 * HNSW_M * 4)
+    return index.ntotal * index.d * 4
+
+def estimate_index_bytes(loaded_index):
+    """Rough in-memory footprint of a loaded index (vectors, chunk text and metadata)"""
+    vector_bytes = vector_index_bytes(loaded_index.vector_store.index)
+    # Memory-mapped chunk texts live in the shared page cache and aren't counted
+    docstore = getattr(loaded_index.vector_store.docstore, "_dict", {})
+    text_bytes = sum(len(doc.page_content) for doc in docstore.values())
+    metadata_bytes = len(loaded_index.chunk_table) * 32 + loaded_index.lexical_index.nbytes()
+    return vector_bytes + text_bytes + metadata_bytes
+
+class VectorStoreRegistry:
+    """Process-wide LRU cache of loaded FAISS indexes, bounded by memory footprint"""
+    
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # index path -> (version, loaded index, size in bytes)
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+    
+    def get(self, index_path, embeddings):
+        """Return the loaded index at index_path, loading it from disk only if it changed"""
+        key = os.path.abspath(index_path)
+        version = index_version(index_path)
+        
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] == version:
+                self._entries.move_to_end(key)
+                return entry[1]
+        
+        loaded_index = load_index(index_path, embeddings)
+        self.put(index_path, loaded_index, version)
+        return loaded_index
+    
+    def put(self, index_path, loaded_index, version=None):
+        """Register a freshly built or loaded index, replacing any older build at the same path"""
+        key = os.path.abspath(index_path)
+        if version is None:
+            version = index_version(index_path)
+        size = estimate_index_bytes(loaded_index)
+        
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (version, loaded_index, size)
+            self._total_bytes += size
+            # Evict least recently used indexes, but always keep the newest one
+            while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+                oldest_key = next(iter(self._entries))
+                self._discard(oldest_key)
+    
+    def invalidate(self, index_path):
+        """Drop an index from memory, e.g. before it is rebuilt"""
+        with self._lock:
+            self._discard(os.path.abspath(index_path))
+    
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self._total_bytes -= entry[2]
+
+@process_resource
+def get_vector_store_registry():
+    """Return the process-wide vector store registry"""
+    return VectorStoreRegistry(INDEX_REGISTRY_MAX_BYTES)
+
+class TokenBucket:
+    """Thread-safe token bucket that limits how fast requests are sent"""
+    
+    def __init__(self, rate_per_second, capacity):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquire(self, tokens=1):
+        """Block until the requested number of tokens is available"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+@process_resource
+def get_embedding_rate_limiter(backend=EMBEDDING_BACKEND):
+    """Return the process-wide rate limiter shared by all embedding requests, or None for local backends"""
+    _, is_remote = EMBEDDING_BACKENDS.get(backend, (None, True))
+    if not is_remote:
+        return None
+    rate = EMBEDDING_REQUESTS_PER_MINUTE / 60
+    return TokenBucket(rate, capacity=max(1, EMBEDDING_MAX_WORKERS))
+
+def is_retryable_embedding_error(error):
+    """Rate limits, timeouts and transient server errors are worth retrying"""
+    status = getattr(error, "status_code", None) or getattr(error, "code", None)
+    if callable(status):
+        status = status()
+    if status in (429, 500, 502, 503, 504):
+        return True
+    
+    retryable_types = ("ResourceExhausted", "ServiceUnavailable", "DeadlineExceeded",
+                       "InternalServerError", "TooManyRequests", "TimeoutError", "ConnectionError")
+    if type(error).__name__ in retryable_types:
+        return True
+    
+    message = str(error).lower()
+    return any(marker in message for marker in ("429", "rate limit", "quota", "resource exhausted",
+                                                 "unavailable", "timed out", "timeout"))
+
+def embed_batch_with_retry(embeddings, batch, rate_limiter, max_retries=EMBEDDING_MAX_RETRIES,
+                           base_delay=EMBEDDING_RETRY_BASE_DELAY):
+    """Embed one batch of texts, backing off exponentially on retryable errors
+
+    Raises EmbeddingError once the error isn't retryable or the retries are used up.
+    """
+    for attempt in range(max_retries + 1):
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        try:
+            return embeddings.embed_documents(batch)
+        except Exception as error:
+            if attempt == max_retries or not is_retryable_embedding_error(error):
+                raise EmbeddingError(str(error)) from error
+            # Full jitter keeps concurrent workers from retrying in lockstep
+            time.sleep(random.uniform(0, base_delay * (2 ** attempt)))
+
+def normalize_chunk_text(text):
+    """Canonical form of a chunk for cache lookups (unicode and whitespace normalized)"""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+class EmbeddingCache:
+    """SQLite-backed store of chunk embeddings keyed by (model, SHA-256 of normalized text)"""
+    
+    def __init__(self, path, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # Memory-map the database file so vector blobs are read straight from the page cache
+        self._conn.execute(f"PRAGMA mmap_size={max_bytes}")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, text_hash)
+            ) WITHOUT ROWID
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        # Bytes of stored vectors, kept in the database so every process sharing the file sees the
+        # others' inserts and deletes; summed once when the row is first created
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS embedding_usage (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                total_bytes INTEGER NOT NULL
+            )
+        """)
+        self._conn.execute("""
+            INSERT OR IGNORE INTO embedding_usage (id, total_bytes)
+            SELECT 0, COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings
+        """)
+        self._conn.commit()
+    
+    @staticmethod
+    def text_hash(text):
+        return hashlib.sha256(normalize_chunk_text(text).encode("utf-8")).hexdigest()
+    
+    def _select_by_hash(self, columns, model, hashes):
+        """Rows of the given columns for the given text hashes of one model"""
+        # Stay well below SQLite's bound-parameter limit
+        for start in range(0, len(hashes), 500):
+            part = hashes[start:start + 500]
+            placeholders = ",".join("?" * len(part))
+            yield from self._conn.execute(
+                f"SELECT {columns} FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                [model, *part]
+            )
+    
+    def get_many(self, model, texts):
+        """Return a list with the cached vector for each text, or None where it is missing"""
+        hashes = [self.text_hash(text) for text in texts]
+        found = {}
+        with self._lock:
+            for text_hash, blob in self._select_by_hash("text_hash, vector", model, hashes):
+                vector = array("f")
+                vector.frombytes(blob)
+                found[text_hash] = vector.tolist()
+            
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?",
+                    [(now, model, text_hash) for text_hash in found]
+                )
+                self._conn.commit()
+            
+            vectors = [found.get(text_hash) for text_hash in hashes]
+            hits = sum(vector is not None for vector in vectors)
+            self.hits += hits
+            self.misses += len(vectors) - hits
+        return vectors
+    
+    def put_many(self, model, texts, vectors):
+        """Store freshly computed vectors, then evict old entries if over budget"""
+        now = time.time()
+        # Repeated texts in one batch are stored once, with the last vector
+        blobs = {self.text_hash(text): array("f", vector).tobytes() for text, vector in zip(texts, vectors)}
+        with self._lock:
+            # Take the write lock up front, so no other process changes these rows or the total in between
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Replaced rows no longer count towards the stored bytes
+                replaced = sum(size for (size,) in self._select_by_hash("LENGTH(vector)", model, list(blobs)))
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings (model, text_hash, vector, last_used) VALUES (?, ?, ?, ?)",
+                    [(model, text_hash, blob, now) for text_hash, blob in blobs.items()]
+                )
+                self._add_bytes(sum(map(len, blobs.values())) - replaced)
+                self._evict()
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+    
+    def _add_bytes(self, delta):
+        self._conn.execute("UPDATE embedding_usage SET total_bytes = total_bytes + ? WHERE id = 0", (delta,))
+    
+    def stored_bytes(self):
+        """Bytes of vectors stored by every process using the cache file"""
+        (total_bytes,) = self._conn.execute("SELECT total_bytes FROM embedding_usage WHERE id = 0").fetchone()
+        return total_bytes
+    
+    def _evict(self):
+        """Delete least recently used vectors until the stored bytes fit the budget"""
+        total_bytes = self.stored_bytes()
+        if total_bytes <= self.max_bytes:
+            return
+        # Trim to 90% so eviction doesn't run again on the very next insert
+        excess = total_bytes - int(self.max_bytes * 0.9)
+        rows = self._conn.execute("SELECT model, text_hash, LENGTH(vector) FROM embeddings ORDER BY last_used")
+        stale = []
+        freed = 0
+        for model, text_hash, size in rows:
+            if freed >= excess:
+                break
+            stale.append((model, text_hash))
+            freed += size
+        self._conn.executemany("DELETE FROM embeddings WHERE model = ? AND text_hash = ?", stale)
+        self._add_bytes(-freed)
+    
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+@process_resource
+def get_embedding_cache():
+    """Return the process-wide chunk embedding cache"""
+    return EmbeddingCache(EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_MAX_BYTES)
+
+def index_chunk_stream(chunks, embeddings, rate_limiter, vector_store=None, embedding_cache=None,
+                       model_name=None, batch_size=EMBEDDING_BATCH_SIZE,
+                       max_workers=EMBEDDING_MAX_WORKERS, max_pending=EMBEDDING_MAX_PENDING_BATCHES,
+                       on_progress=None):
+    """Embed a stream of (chunk id, chunk text) pairs in concurrent batches, adding vectors to the index as batches finish
+
+    The stream is only read further while fewer than max_pending batches are waiting
+    on the embedding API, so memory is bounded by the batch size, not the corpus size.
+    """
+    indexed = 0
+    model_name = model_name or embedding_model_name()
+    
+    def add_to_index(text_embeddings, ids):
+        nonlocal vector_store, indexed
+        if vector_store is None:
+            vector_store = FAISS.from_embeddings(text_embeddings, embeddings, ids=ids)
+        else:
+            vector_store.add_embeddings(text_embeddings, ids=ids)
+        indexed += len(ids)
+        if on_progress:
+            on_progress(indexed)
+    
+    def iter_batches():
+        batch = []
+        for item in chunks:
+            batch.append(item)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+        
+        def collect(done):
+            for future in done:
+                batch = pending.pop(future)
+                vectors = future.result()
+                batch_chunks = [chunk for _, chunk in batch]
+                if embedding_cache is not None:
+                    embedding_cache.put_many(model_name, batch_chunks, vectors)
+                add_to_index(list(zip(batch_chunks, vectors)), [cid for cid, _ in batch])
+        
+        try:
+            for batch in iter_batches():
+                missing = batch
+                if embedding_cache is not None:
+                    cached_vectors = embedding_cache.get_many(model_name, [chunk for _, chunk in batch])
+                    cached = [(item, vector) for item, vector in zip(batch, cached_vectors) if vector is not None]
+                    missing = [item for item, vector in zip(batch, cached_vectors) if vector is None]
+                    if cached:
+                        add_to_index([(chunk, vector) for (_, chunk), vector in cached],
+                                     [cid for (cid, _), _ in cached])
+                
+                # Only cache misses are sent to the embedding API
+                if missing:
+                    future = executor.submit(embed_batch_with_retry, embeddings, [chunk for _, chunk in missing], rate_limiter)
+                    pending[future] = missing
+                
+                # Backpressure: wait for a batch to finish before reading further
+                while len(pending) >= max_pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+            
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+        except Exception:
+            # Don't keep spending quota on batches whose results will be thrown away
+            for future in pending:
+                future.cancel()
+            raise
+    
+    return vector_store
+
+def choose_index_type(vector_count):
+    """Pick the FAISS index type for a corpus of the given size"""
+    if vector_count < ANN_MIN_TRAIN_VECTORS:
+        return "flat"
+    if ANN_INDEX_TYPE != "auto":
+        return ANN_INDEX_TYPE
+    if vector_count < FLAT_INDEX_MAX_VECTORS:
+        return "flat"
+    if vector_count < HNSW_INDEX_MAX_VECTORS:
+        return "hnsw"
+    if vector_count < IVF_FLAT_INDEX_MAX_VECTORS:
+        return "ivf_flat"
+    return "ivf_pq"
+
+def ivf_list_count(vector_count):
+    # About 4 * sqrt(n) lists, but never so many that training runs short of points
+    return max(1, min(int(4 * math.sqrt(vector_count)), vector_count // 39))
+
+def pq_subquantizers(dimension):
+    """Largest usual subquantizer count that divides the vector dimension"""
+    return next(m for m in (64, 48, 32, 16, 8, 4, 2, 1) if dimension % m == 0)
+
+def search_parameters(index, selector=None, tuning=None):
+    """Search parameters of the right kind for the index; IVF and HNSW reject the generic kind
+
+    tuning overrides the configured nprobe (IVF) or efSearch (HNSW).
+    """
+    if isinstance(index, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=tuning or IVF_NPROBE)
+    if isinstance(index, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=tuning or HNSW_EF_SEARCH)
+    if selector is not None:
+        return faiss.SearchParameters(sel=selector)
+    return None
+
+class VectorSpill:
+    """Append-only file of float32 vectors that stands in for the FAISS index while a corpus is ingested
+
+    Embedding batches are written straight to disk, so ingestion holds no index in memory;
+    optimize_vector_index then picks the index type for the final count and fills it from the file.
+    """
+    
+    def __init__(self, path, metric_type=faiss.METRIC_L2):
+        self.path = path
+        self.metric_type = metric_type
+        self.ntotal = 0
+        self.d = None
+        open(path, "wb").close()
+    
+    @classmethod
+    def from_index(cls, index, path):
+        """Move the vectors of an index into a spill file, emptying the index
+
+        Vectors come back exactly from every index type except IVF-PQ, which stores compressed codes.
+        """
+        if isinstance(index, faiss.IndexIVF):
+            index.make_direct_map()
+        spill = cls(path, index.metric_type)
+        for start in range(0, index.ntotal, ANN_ADD_BATCH_SIZE):
+            spill.add(index.reconstruct_n(start, min(ANN_ADD_BATCH_SIZE, index.ntotal - start)))
+        index.reset()
+        return spill
+    
+    def add(self, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype="float32")
+        self.d = vectors.shape[1]
+        with open(self.path, "ab") as spill_file:
+            spill_file.write(vectors.tobytes())
+        self.ntotal += len(vectors)
+    
+    def vectors(self):
+        """Memory-map every vector written so far as an (ntotal, d) array"""
+        return np.memmap(self.path, dtype="float32", mode="r", shape=(self.ntotal, self.d))
+
+def build_vector_index(vectors, index_type, metric_type=faiss.METRIC_L2):
+    """Build an index of the given type from an (n, d) array of vectors, training approximate ones on a sample first
+
+    The vectors are read in blocks, so when they are memory-mapped only the new index is held in memory.
+    """
+    vector_count, dimension = vectors.shape
+    if index_type == "flat":
+        index = faiss.IndexFlat(dimension, metric_type)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dimension, HNSW_M, metric_type)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    else:
+        nlist = ivf_list_count(vector_count)
+        if index_type == "ivf_pq":
+            description = f"IVF{nlist},PQ{pq_subquantizers(dimension)}"
+        else:
+            description = f"IVF{nlist},Flat"
+        index = faiss.index_factory(dimension, description, metric_type)
+        sample_size = min(vector_count, nlist * ANN_TRAIN_POINTS_PER_LIST)
+        sample_ids = np.sort(np.random.default_rng(0).choice(vector_count, sample_size, replace=False))
+        index.train(np.ascontiguousarray(vectors[sample_ids]))
+    
+    for start in range(0, vector_count, ANN_ADD_BATCH_SIZE):
+        index.add(np.ascontiguousarray(vectors[start:start + ANN_ADD_BATCH_SIZE]))
+    return index
+
+def index_type_of(index):
+    """The index type name of a built FAISS index, or None for a VectorSpill"""
+    if isinstance(index, VectorSpill):
+        return None
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivf_flat"
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    return "flat"
+
+def can_update_in_place(index_type, kept_count, removing):
+    """Whether a published index of this type can take an upload change without re-reading every PDF
+
+    Vectors can be added to every type and removed from flat and IVF indexes, and all but IVF-PQ
+    give their vectors back exactly if the new count calls for a different type.
+    """
+    if removing and index_type == "hnsw":
+        # HNSW graphs can't drop nodes
+        return False
+    if index_type == "ivf_pq" and choose_index_type(kept_count) != "ivf_pq":
+        # Leaving IVF-PQ needs the original vectors, which only the PDFs and the embedding cache have
+        return False
+    return True
+
+def delete_chunks(vector_store, chunk_ids):
+    """Delete chunks from a vector store so the remaining vectors keep contiguous positions
+
+    The FAISS store expects positions to shift down like a flat index's; IVF lists keep the
+    old IDs, so those are renumbered afterwards.
+    """
+    index = vector_store.index
+    removed = None
+    if isinstance(index, faiss.IndexIVF):
+        wanted = set(chunk_ids)
+        removed = np.array(sorted(position for position, cid in vector_store.index_to_docstore_id.items()
+                                  if cid in wanted), dtype="int64")
+        # The position -> list map can't delete; it is rebuilt afterwards
+        index.make_direct_map(False)
+    vector_store.delete(chunk_ids)
+    if removed is not None:
+        invlists = index.invlists
+        for list_no in range(index.nlist):
+            size = invlists.list_size(list_no)
+            if size:
+                ids = faiss.rev_swig_ptr(invlists.get_ids(list_no), size)
+                ids -= np.searchsorted(removed, ids)
+        index.make_direct_map()
+
+def exact_neighbours(vectors, queries, k, metric_type=faiss.METRIC_L2):
+    """IDs of the k nearest vectors to each query by brute force, reading the vectors in blocks"""
+    heap = faiss.ResultHeap(len(queries), k, keep_max=metric_type == faiss.METRIC_INNER_PRODUCT)
+    for start in range(0, len(vectors), ANN_ADD_BATCH_SIZE):
+        block = np.ascontiguousarray(vectors[start:start + ANN_ADD_BATCH_SIZE])
+        distances, found = faiss.knn(queries, block, min(k, len(block)), metric=metric_type)
+        heap.add_result(distances, np.where(found >= 0, found + start, -1))
+    heap.finalize()
+    return heap.I
+
+def measure_recall(vectors, ann_index, k=NUM_FALLBACK_DOCS):
+    """Recall@k and latency of an approximate index against exact search, over a sweep of settings
+
+    Stored vectors serve as the sample queries.
+    """
+    vector_count = len(vectors)
+    query_ids = np.random.default_rng(1).choice(vector_count, min(ANN_RECALL_QUERIES, vector_count), replace=False)
+    queries = np.ascontiguousarray(vectors[np.sort(query_ids)])
+    k = min(k, vector_count)
+    
+    started = time.perf_counter()
+    truth = exact_neighbours(vectors, queries, k, ann_index.metric_type)
+    exact_ms = (time.perf_counter() - started) * 1000 / len(queries)
+    
+    if isinstance(ann_index, faiss.IndexIVF):
+        setting, values = "nprobe", [value for value in (1, 4, IVF_NPROBE, 64, 256) if value <= ann_index.nlist]
+    else:
+        setting, values = "efSearch", [16, 32, HNSW_EF_SEARCH, 128, 256]
+    
+    sweep = []
+    for value in sorted(set(values)):
+        started = time.perf_counter()
+        _, found = ann_index.search(queries, k, params=search_parameters(ann_index, tuning=value))
+        ms_per_query = (time.perf_counter() - started) * 1000 / len(queries)
+        hits = sum(len(set(found_row[found_row >= 0]) & set(truth_row)) for found_row, truth_row in zip(found, truth))
+        sweep.append({setting: value, "recall": hits / truth.size, "ms_per_query": ms_per_query})
+    return {"setting": setting, "exact_ms_per_query": exact_ms, "sweep": sweep}
+
+def optimize_vector_index(vector_store, previous_report=None):
+    """Give the vector store the index type that suits the corpus size
+
+    Ingestion leaves the vectors in a VectorSpill, or in the published index type after an
+    incremental update. An index of the right type is kept; otherwise the new index is filled
+    from disk, so the vectors are never held in memory twice. Returns a report of the chosen
+    type, its size and, for approximate indexes, its recall (carried over from previous_report
+    when the index is kept).
+    """
+    index = vector_store.index
+    index_type = choose_index_type(index.ntotal)
+    report = {"index_type": index_type, "vectors": index.ntotal}
+    if index_type == index_type_of(index):
+        report["bytes"] = vector_index_bytes(index)
+        if previous_report and index_type != "flat":
+            # Only vectors were added or removed; recall was measured when the lists or graph were built
+            report.update({key: value for key, value in previous_report.items() if key not in report})
+        return report
+    
+    with tempfile.TemporaryDirectory() as spill_dir:
+        if not isinstance(index, VectorSpill):
+            index = VectorSpill.from_index(index, os.path.join(spill_dir, "vectors.f32"))
+        vectors = index.vectors()
+        new_index = build_vector_index(vectors, index_type, index.metric_type)
+        if index_type != "flat":
+            report.update(measure_recall(vectors, new_index))
+            report["configured"] = IVF_NPROBE if report["setting"] == "nprobe" else HNSW_EF_SEARCH
+        del vectors
+    vector_store.index = new_index
+    report["bytes"] = vector_index_bytes(new_index)
+    return report
+
+def directory_size(path):
+    """Total size in bytes of the files below path"""
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                continue
+    return total
+
+class IndexStore:
+    """Content-addressed FAISS indexes on disk, one directory per corpus key"""
+    
+    def __init__(self, root, max_bytes, ref_ttl=INDEX_REF_TTL_SECONDS):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ref_ttl = ref_ttl
+        self._refs = {}  # corpus key -> {holder id: last seen timestamp}
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+    
+    def path_for(self, corpus_key):
+        return os.path.join(self.root, corpus_key)
+    
+    def exists(self, corpus_key):
+        return os.path.isdir(self.path_for(corpus_key))
+    
+    def load_manifest(self, corpus_key):
+        """Return the {file key: {"name", "chunks"}} manifest of a published index, if it has one"""
+        try:
+            with open(os.path.join(self.path_for(corpus_key), "manifest.json"), encoding="utf-8") as manifest_file:
+                return json.load(manifest_file)["files"]
+        except (OSError, ValueError, KeyError):
+            return None
+    
+    def load_index_report(self, corpus_key):
+        """Return the index type and recall report saved with a published index, if any"""
+        try:
+            with open(os.path.join(self.path_for(corpus_key), "manifest.json"), encoding="utf-8") as manifest_file:
+                return json.load(manifest_file).get("index")
+        except (OSError, ValueError):
+            return None
+    
+    def publish(self, corpus_key, loaded_index, manifest, index_report=None):
+        """Write an index to a temporary directory, then rename it into place atomically"""
+        final_path = self.path_for(corpus_key)
+        temp_path = tempfile.mkdtemp(prefix=f".{corpus_key}.", dir=self.root)
+        try:
+            save_vector_store(loaded_index.vector_store, temp_path)
+            loaded_index.chunk_table.save(os.path.join(temp_path, "chunks.json"))
+            loaded_index.lexical_index.save(temp_path)
+            with open(os.path.join(temp_path, "manifest.json"), "w", encoding="utf-8") as manifest_file:
+                json.dump({"files": manifest, "index": index_report}, manifest_file)
+            try:
+                os.rename(temp_path, final_path)
+            except OSError:
+                # Another session published the same corpus first; theirs is identical
+                if not os.path.isdir(final_path):
+                    raise
+                shutil.rmtree(temp_path, ignore_errors=True)
+        except Exception:
+            shutil.rmtree(temp_path, ignore_errors=True)
+            raise
+        return final_path
+    
+    def acquire(self, corpus_key, holder):
+        """Mark an index as in use by a session so garbage collection keeps it"""
+        with self._lock:
+            self._refs.setdefault(corpus_key, {})[holder] = time.time()
+        try:
+            # The directory mtime doubles as the last-used time for garbage collection
+            os.utime(self.path_for(corpus_key))
+        except OSError:
+            pass
+    
+    def release(self, corpus_key, holder):
+        with self._lock:
+            holders = self._refs.get(corpus_key, {})
+            holders.pop(holder, None)
+            if not holders:
+                self._refs.pop(corpus_key, None)
+    
+    def ref_count(self, corpus_key):
+        """Number of sessions that used the index within the reference TTL"""
+        cutoff = time.time() - self.ref_ttl
+        with self._lock:
+            holders = self._refs.get(corpus_key, {})
+            for holder in [h for h, seen in holders.items() if seen < cutoff]:
+                del holders[holder]
+            return len(holders)
+    
+    def collect_garbage(self, registry=None):
+        """Delete least recently used, unreferenced indexes until disk usage fits the budget"""
+        entries = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if not os.path.isdir(path):
+                continue
+            if name.startswith("."):
+                # Leftover temporary directory from an interrupted publish
+                if os.path.getmtime(path) < time.time() - self.ref_ttl:
+                    shutil.rmtree(path, ignore_errors=True)
+                continue
+            entries.append((os.path.getmtime(path), name, directory_size(path)))
+        
+        total_bytes = sum(size for _, _, size in entries)
+        removed = []
+        for _, corpus_key, size in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            if self.ref_count(corpus_key) > 0:
+                continue
+            path = self.path_for(corpus_key)
+            if registry is not None:
+                registry.invalidate(path)
+            shutil.rmtree(path, ignore_errors=True)
+            total_bytes -= size
+            removed.append(corpus_key)
+        return removed
+
+@process_resource
+def get_index_store():
+    """Return the process-wide index store"""
+    return IndexStore(INDEX_STORE_ROOT, INDEX_STORE_MAX_BYTES)
+
+def make_text_splitter():
+    # Improved text splitting with better parameters
+    return RecursiveCharacterTextSplitter(
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP,
+        length_function=len,
+        separators=SPLITTER_SEPARATORS
+    )
+
+def iter_chunks(pages):
+    """Split a stream of pages into chunks, holding only a few chunks of text at a time
+
+    Yields (file key, chunk, page start, page end, char start, char end). Pages are joined with
+    blank lines, and character offsets point into that per-file text.
+    """
+    text_splitter = make_text_splitter()
+    current_key = None
+    buffer = ""
+    buffer_offset = 0  # Offset of buffer[0] in the current file's text
+    file_length = 0
+    page_offsets = []  # Offset where each page of the current file starts
+    page_numbers = []
+    
+    def page_at(offset):
+        return page_numbers[bisect.bisect_right(page_offsets, offset) - 1]
+    
+    def drain(final):
+        nonlocal buffer, buffer_offset
+        text_chunks = text_splitter.split_text(buffer)
+        positions = []
+        search_from = 0
+        for chunk in text_chunks:
+            position = buffer.find(chunk, search_from)
+            if position < 0:  # Shouldn't happen, but keep offsets monotonic if it does
+                position = search_from
+            positions.append(position)
+            search_from = position + 1
+        
+        if final:
+            carry = len(buffer)
+        else:
+            # The last chunk may continue on the next page, so split it again once more text arrives
+            carry = positions.pop() if text_chunks else 0
+            text_chunks = text_chunks[:len(positions)]
+        
+        results = []
+        for chunk, position in zip(text_chunks, positions):
+            # Filter out very short chunks that might not be useful
+            if len(chunk.strip()) > MIN_CHUNK_LENGTH:
+                start = buffer_offset + position
+                end = start + len(chunk)
+                results.append((chunk, page_at(start), page_at(end - 1), start, end))
+        
+        buffer = buffer[carry:]
+        buffer_offset += carry
+        return results
+    
+    for file_key, file_name, page_num, page_text in pages:
+        page_text = preprocess_text(page_text)
+        if not page_text:  # Only add non-empty pages
+            continue
+        if file_key != current_key:
+            if current_key is not None:
+                for chunk in drain(final=True):
+                    yield (current_key, *chunk)
+            current_key = file_key
+            buffer, buffer_offset, file_length = "", 0, 0
+            page_offsets, page_numbers = [], []
+        
+        separator = "\n\n" if file_length else ""
+        page_offsets.append(file_length + len(separator))
+        page_numbers.append(page_num + 1)
+        buffer += separator + page_text
+        file_length += len(separator) + len(page_text)
+        
+        if len(buffer) >= 4 * CHUNK_SIZE:
+            for chunk in drain(final=False):
+                yield (current_key, *chunk)
+    
+    if current_key is not None:
+        for chunk in drain(final=True):
+            yield (current_key, *chunk)
+
+def build_index(files, corpus_key, base_key=None, on_progress=None):
+    """Create FAISS vector store for the uploaded files and publish it under the corpus key
+
+    If base_key names a published index, only the files added or removed since then are
+    processed: their vectors are added to or deleted from a copy of that index.
+    on_progress, if given, is called with a short status message as work proceeds.
+    Returns the number of chunks in the published index.
+    """
+    index_store = get_index_store()
+    files_by_key = {compute_file_key(file): file for file in files}
+    report = on_progress or (lambda message: None)
+    
+    embeddings = get_embeddings()
+    registry = get_vector_store_registry()
+    embedding_cache = get_embedding_cache()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # Vectors and chunk texts are spilled to files here until the index is published
+        vector_store = None
+        chunk_table = ChunkTable()
+        lexical_index = BM25Index()
+        manifest = index_store.load_manifest(base_key) if base_key and index_store.exists(base_key) else None
+        base_report = index_store.load_index_report(base_key) if manifest is not None else None
+        if base_report:
+            kept_count = sum(entry["chunks"] for file_key, entry in manifest.items() if file_key in files_by_key)
+            removing = len(manifest) > sum(file_key in files_by_key for file_key in manifest)
+            if not can_update_in_place(base_report["index_type"], kept_count, removing):
+                # Rebuild from the PDFs instead (the embedding cache avoids re-embedding)
+                manifest = None
+        if manifest is not None:
+            # Load a private copy: the registry's instance may be serving other sessions
+            base_index = load_index(index_store.path_for(base_key), embeddings, spill_dir=temp_dir)
+            vector_store, chunk_table = base_index.vector_store, base_index.chunk_table
+            lexical_index = base_index.lexical_index
+        else:
+            manifest = {}
+            # A new corpus: vectors go to disk until the index type can be chosen for the final count
+            vector_store = FAISS(embeddings, VectorSpill(os.path.join(temp_dir, "vectors.f32")), TextSpill(temp_dir), {})
+        
+        # Drop the vectors of files that are no longer uploaded
+        removed_keys = [file_key for file_key in manifest if file_key not in files_by_key]
+        removed_ids = [chunk_id(file_key, position)
+                       for file_key in removed_keys
+                       for position in range(manifest[file_key]["chunks"])]
+        if removed_ids:
+            delete_chunks(vector_store, removed_ids)
+        chunk_table.remove_files(removed_keys)
+        lexical_index.remove_files(removed_keys)
+        for file_key in removed_keys:
+            del manifest[file_key]
+        
+        # Only newly added files are parsed, split and embedded, streaming page by page
+        added_keys = [file_key for file_key in files_by_key if file_key not in manifest]
+        for file_key in added_keys:
+            manifest[file_key] = {"name": files_by_key[file_key].name, "chunks": 0}
+        
+        def numbered_chunks(pages):
+            # A file's lexical postings are collected as its chunks stream past; only the text of the
+            # chunk in hand is kept
+            segment_builder = None
+            current_key = None
+            for file_key, chunk, page_start, page_end, char_start, char_end in iter_chunks(pages):
+                if file_key != current_key:
+                    if current_key is not None:
+                        lexical_index.add_segment(current_key, segment_builder.finish())
+                    current_key, segment_builder = file_key, BM25SegmentBuilder()
+                position = manifest[file_key]["chunks"]
+                manifest[file_key]["chunks"] += 1
+                cid = chunk_id(file_key, position)
+                chunk_table.append(cid, file_key, manifest[file_key]["name"],
+                                   page_start, page_end, char_start, char_end)
+                segment_builder.add(position, chunk)
+                yield cid, chunk
+            if current_key is not None:
+                lexical_index.add_segment(current_key, segment_builder.finish())
+        
+        # Failed embedding requests raise EmbeddingError; PDF, splitting and disk errors surface as themselves
+        pages = iter_pdf_pages([(file_key, files_by_key[file_key]) for file_key in added_keys], temp_dir)
+        vector_store = index_chunk_stream(
+            numbered_chunks(pages),
+            embeddings,
+            get_embedding_rate_limiter(),
+            vector_store=vector_store,
+            embedding_cache=embedding_cache,
+            on_progress=lambda indexed: report(f"Embedded {indexed} text chunks...")
+        )
+        
+        chunk_count = sum(entry["chunks"] for entry in manifest.values())
+        if not chunk_count:
+            raise IngestionError("No valid text chunks created! Please check your PDF content.")
+        
+        report("Optimizing the vector index...")
+        index_report = optimize_vector_index(vector_store, base_report)
+        index_path = index_store.publish(corpus_key, LoadedIndex(vector_store, chunk_table, lexical_index),
+                                         manifest, index_report)
+    
+    # Keep the published index in memory so the first question doesn't reload it; its chunk texts are
+    # memory-mapped from the published files rather than held by this build
+    registry.get(index_path, embeddings)
+    index_store.collect_garbage(registry)
+    return chunk_count
+
+def ingest(files, base_key=None, on_progress=None):
+    """Index uploaded files, reusing an identical published index when there is one
+
+    Returns the corpus key, chunk count, index report and embedding cache statistics.
+    """
+    corpus_key = compute_ingestion_key(files)
+    index_store = get_index_store()
+    if index_store.exists(corpus_key):
+        # Same documents as an index published before (by anyone): share it
+        loaded_index = get_vector_store_registry().get(index_store.path_for(corpus_key), get_embeddings())
+        chunk_count = loaded_index.vector_store.index.ntotal
+    else:
+        chunk_count = build_index(files, corpus_key, base_key, on_progress)
+    return {
+        "corpus_key": corpus_key,
+        "chunk_count": chunk_count,
+        "index_report": index_store.load_index_report(corpus_key),
+        "embedding_cache_stats": get_embedding_cache().stats(),
+    }
+
+def describe_corpus(corpus_key):
+    """Files, page range and index report of a published corpus, for building search scopes"""
+    index_store = get_index_store()
+    chunk_table = get_vector_store_registry().get(index_store.path_for(corpus_key), get_embeddings()).chunk_table
+    return {
+        "corpus_key": corpus_key,
+        "files": [{"file_key": file_key, "name": name}
+                  for file_key, name in zip(chunk_table.file_keys, chunk_table.file_names)],
+        "max_page": max(1, chunk_table.max_page()),
+        "index_report": index_store.load_index_report(corpus_key),
+    }
+
+@process_resource
+def get_answer_chain():
+    """Build the answer model client, prompt and stuff chain once per process
+
+    Questions only fill in the chain's context and question; the shared client keeps
+    its connection to the Gemini API open between them.
+    """
+    # Enhanced prompt template with better instructions
+    prompt_template = """
+    You are an intelligent AI assistant analyzing a document. Use the provided context to answer the question as comprehensively as possible.
+
+    INSTRUCTIONS:
+    1. If you find relevant information in the context, provide a detailed and helpful answer
+    2. If the exact answer isn't available, try to provide related information that might be helpful
+    3. If you can make reasonable inferences from the available information, do so while indicating they are inferences
+    4. Only say "Answer is not available in the context" if there is absolutely no relevant information
+    5. Be conversational and helpful in your tone
+    6. If appropriate, suggest what additional information might be needed
+
+    Context:
+    {context}
+
+    Question: {question}
+
+    Helpful Answer:
+    """
+    
+    # Initialize model
+    model = ChatGoogleGenerativeAI(
+        model="gemini-2.0-flash-exp", 
+        temperature=0.4,
+        google_api_key=os.getenv("GOOGLE_API_KEY")
+    )
+    
+    prompt = PromptTemplate(template=prompt_template, input_variables=["context", "question"])
+    chain = load_qa_chain(model, chain_type="stuff", prompt=prompt)
+    
+    return chain
+
+def stream_chain(chain, docs, question):
+    """Yield the stuff chain's answer text piece by piece as the model generates it"""
+    llm_chain = chain.llm_chain
+    context = chain.document_separator.join(format_document(doc, chain.document_prompt) for doc in docs)
+    prompt = llm_chain.prompt.format(**{chain.document_variable_name: context, "question": question})
+    for message_chunk in llm_chain.llm.stream(prompt):
+        if message_chunk.content:
+            yield message_chunk.content
+
+def collect_chain_answer(chain, docs, question, cancelled):
+    """Generate a complete answer in the background, giving up as soon as cancelled is set"""
+    answer = ""
+    for piece in stream_chain(chain, docs, question):
+        if cancelled.is_set():
+            return None
+        answer += piece
+    return answer
+
+@process_resource
+def get_answer_executor():
+    """Return the process-wide thread pool for speculative fallback answers"""
+    return ThreadPoolExecutor(max_workers=ANSWER_MAX_WORKERS)
+
+def enhance_query(query):
+    """Enhance user query with synonyms and related terms"""
+    # Simple query enhancement - you can make this more sophisticated
+    enhanced_terms = []
+    
+    # Add the original query
+    enhanced_terms.append(query)
+    
+    # Add variations (you can expand this with a proper thesaurus)
+    common_synonyms = {
+        "summary": ["overview", "abstract", "conclusion", "main points"],
+        "benefits": ["advantages", "positives", "pros", "value"],
+        "problems": ["issues", "challenges", "difficulties", "concerns"],
+        "cost": ["price", "expense", "budget", "financial"],
+        "process": ["procedure", "method", "steps", "approach"],
+        "result": ["outcome", "finding", "conclusion", "effect"]
+    }
+    
+    query_lower = query.lower()
+    for key, synonyms in common_synonyms.items():
+        if key in query_lower:
+            enhanced_terms.extend(synonyms)
+    
+    return " ".join(enhanced_terms)
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after a fixed time"""
+    
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expiry timestamp, value)
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+    
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def items(self):
+        """Snapshot of the unexpired (key, value) pairs"""
+        now = time.time()
+        with self._lock:
+            return [(key, value) for key, (expiry, value) in self._entries.items() if expiry >= now]
+
+@process_resource
+def get_query_embedding_cache():
+    """Return the process-wide cache of query embeddings"""
+    return TTLCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL_SECONDS)
+
+def normalize_query(query):
+    return " ".join(query.lower().split())
+
+def embed_queries(embeddings, queries):
+    """Embed several search queries, sending every uncached one in a single embedding call"""
+    cache = get_query_embedding_cache()
+    model_name = embedding_model_name()
+    keys = [(model_name, normalize_query(query)) for query in queries]
+    vectors = [cache.get(key) for key in keys]
+    
+    missing = [index for index, vector in enumerate(vectors) if vector is None]
+    if missing:
+        missing_queries = [queries[index] for index in missing]
+        if isinstance(embeddings, GoogleGenerativeAIEmbeddings):
+            fresh_vectors = embeddings.embed_documents(missing_queries, task_type="retrieval_query")
+        else:
+            fresh_vectors = embeddings.embed_documents(missing_queries)
+        for index, vector in zip(missing, fresh_vectors):
+            vectors[index] = vector
+            cache.put(keys[index], vector)
+    return vectors
+
+class AnswerCache:
+    """Stored answers, reused when a new question's vector is close enough to an answered one for the same corpus"""
+    
+    def __init__(self, max_entries, ttl, threshold):
+        self.threshold = threshold
+        # (corpus key, scope, query) -> (unit query vector, answer, citations)
+        self._entries = TTLCache(max_entries, ttl)
+    
+    @staticmethod
+    def _unit(vector):
+        vector = np.asarray(vector, dtype="float32")
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+    
+    def lookup(self, corpus_key, scope, query_vector):
+        """Return the (answer, citations) of the closest answered question, or None"""
+        candidates = [value for (key_corpus, key_scope, _), value in self._entries.items()
+                      if key_corpus == corpus_key and key_scope == scope]
+        if not candidates:
+            return None
+        similarities = np.stack([vector for vector, _, _ in candidates]) @ self._unit(query_vector)
+        best = int(np.argmax(similarities))
+        return candidates[best][1:] if similarities[best] >= self.threshold else None
+    
+    def store(self, corpus_key, scope, query, query_vector, answer, citations=""):
+        self._entries.put((corpus_key, scope, normalize_query(query)), (self._unit(query_vector), answer, citations))
+
+@process_resource
+def get_answer_cache():
+    """Return the process-wide answer cache"""
+    return AnswerCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL_SECONDS, ANSWER_CACHE_SIMILARITY)
+
+def scope_chunk_ids(loaded_index, scope):
+    """Chunk IDs inside a (file keys, page range) scope"""
+    chunk_table = loaded_index.chunk_table
+    return [chunk_table.chunk_ids[row] for row in chunk_table.rows_for(*scope)]
+
+def search_positions_exactly(index, queries, k, positions):
+    """Brute-force search among the stored vectors at the given positions only"""
+    positions = np.array(positions, dtype="int64")
+    distances, found = faiss.knn(queries, index.reconstruct_batch(positions), min(k, len(positions)),
+                                 metric=index.metric_type)
+    return distances, np.where(found >= 0, positions[found], -1)
+
+def search_vectors(loaded_index, query_vectors, k, positions=None):
+    """Search the index with a matrix of query vectors at once, optionally only among the given positions
+
+    Returns one list of (position, distance) pairs per query.
+    """
+    index = loaded_index.vector_store.index
+    queries = np.array(query_vectors, dtype="float32")
+    if positions is None:
+        distances, found = index.search(queries, k, params=search_parameters(index))
+    elif not isinstance(index, faiss.IndexFlat) and len(positions) <= SCOPED_EXACT_SEARCH_MAX_VECTORS:
+        # An ANN index only visits a few lists or graph neighbourhoods per query, which may hold
+        # none of a small scope's vectors; those scopes are searched exactly instead
+        distances, found = search_positions_exactly(index, queries, k, positions)
+    else:
+        # Only the selected vectors are compared against the queries, and the ANN search is
+        # widened by the share of the index the scope leaves out
+        selector = faiss.IDSelectorBatch(np.array(positions, dtype="int64"))
+        widening = index.ntotal / max(1, len(positions))
+        tuning = None
+        if isinstance(index, faiss.IndexIVF):
+            tuning = min(index.nlist, math.ceil(IVF_NPROBE * widening))
+        elif isinstance(index, faiss.IndexHNSW):
+            tuning = math.ceil(HNSW_EF_SEARCH * widening)
+        distances, found = index.search(queries, k, params=search_parameters(index, selector, tuning))
+    return [[(int(position), float(distance)) for position, distance in zip(row_positions, row_distances)
+             if position >= 0]
+            for row_positions, row_distances in zip(found, distances)]
+
+def top_cosine_similarity(index, query_vector, positions):
+    """Highest cosine between a query and the stored vectors at the given positions
+
+    Zero vectors (text without any known term, e.g. for TF-IDF) have no direction and score 0.
+    """
+    query = np.asarray(query_vector, dtype="float32")
+    query_norm = np.linalg.norm(query)
+    if not positions or not query_norm:
+        return 0.0
+    vectors = index.reconstruct_batch(np.array(positions, dtype="int64"))
+    norms = np.linalg.norm(vectors, axis=1) * query_norm
+    cosines = (vectors @ query) / np.maximum(norms, 1e-12)
+    return float(cosines.max())
+
+class RetrievalPlan:
+    """Every query variant the retrieval cascade may need, with its embedding and result count"""
+    
+    def __init__(self, user_input, variants, query_vectors, allowed_ids, positions, candidates=NUM_CONTEXT_DOCS):
+        self.user_input = user_input
+        self.candidates = candidates  # Context hits to return
+        self.variants = variants  # query -> number of results needed
+        self.query_vectors = query_vectors  # query -> embedding
+        self.allowed_ids = allowed_ids  # Chunk IDs in scope, or None for the whole index
+        self.positions = positions  # FAISS positions of allowed_ids
+
+def plan_retrieval(loaded_index, embeddings, user_input, scope=None, candidates=NUM_CONTEXT_DOCS):
+    """Build all query variants up front and embed them together"""
+    allowed_ids = positions = None
+    if scope is not None:
+        allowed_ids = set(scope_chunk_ids(loaded_index, scope))
+        positions = loaded_index.positions_for(allowed_ids)
+    
+    variants = OrderedDict()
+    variants[enhance_query(user_input)] = candidates
+    # The original query also serves the "not available" fallback, which just needs more results
+    variants[user_input] = max(candidates, NUM_FALLBACK_DOCS)
+    
+    queries = list(variants)
+    query_vectors = dict(zip(queries, embed_queries(embeddings, queries)))
+    return RetrievalPlan(user_input, variants, query_vectors, allowed_ids, positions, candidates)
+
+def reciprocal_rank_fusion(rankings, limit):
+    """Merge ranked lists of chunk IDs, scoring each ID by the sum of 1 / (RRF_K + rank)"""
+    scores = {}
+    for ranking in rankings:
+        for rank, cid in enumerate(ranking, start=1):
+            scores[cid] = scores.get(cid, 0.0) + 1.0 / (RRF_K + rank)
+    return sorted(scores, key=scores.get, reverse=True)[:limit]
+
+def retrieve(loaded_index, plan):
+    """Hybrid retrieval: one batched FAISS search plus a BM25 lookup, fused by reciprocal rank
+
+    Returns (context hits, fallback hits, top similarity). Hits are lists of (chunk id, document),
+    deduplicated by chunk ID; the similarity is the cosine of the best vector match.
+    """
+    vector_store = loaded_index.vector_store
+    if plan.positions is not None and not plan.positions:
+        return [], [], 0.0
+    
+    user_input = plan.user_input
+    queries = list(plan.variants)
+    query_vectors = [plan.query_vectors[query] for query in queries]
+    results = dict(zip(queries, search_vectors(loaded_index, query_vectors, max(plan.variants.values()),
+                                               plan.positions)))
+    
+    def chunk_ids(result):
+        return [vector_store.index_to_docstore_id[position] for position, _ in result]
+    
+    candidates = plan.candidates
+    enhanced_ranking = chunk_ids(results[queries[0]][:candidates])
+    original_ranking = chunk_ids(results[user_input])
+    # Exact terms (IDs, names, numbers) are found lexically instead of by per-word vector searches
+    lexical_ranking = loaded_index.lexical_index.search(user_input, max(candidates, NUM_FALLBACK_DOCS),
+                                                        plan.allowed_ids)
+    
+    context = reciprocal_rank_fusion(
+        [enhanced_ranking, original_ranking[:candidates], lexical_ranking[:candidates]],
+        candidates
+    )
+    fallback = reciprocal_rank_fusion([original_ranking[:NUM_FALLBACK_DOCS], lexical_ranking[:NUM_FALLBACK_DOCS]],
+                                      NUM_FALLBACK_DOCS)
+    
+    # Zero vectors sit at the same L2 distance from everything, so the nearest hit isn't always the most
+    # similar one; the cosine is taken over all returned hits from the stored vectors instead
+    top_similarity = max((top_cosine_similarity(vector_store.index, plan.query_vectors[query],
+                                                [position for position, _ in result])
+                          for query, result in results.items()), default=0.0)
+    
+    def to_hits(hit_ids):
+        return [(cid, vector_store.docstore.search(cid)) for cid in hit_ids]
+    
+    return to_hits(context), to_hits(fallback), top_similarity
+
+class LexicalOverlapScorer:
+    """Scores chunks by the share of the question's terms they contain"""
+    
+    def score(self, query, texts):
+        query_terms = set(lexical_tokens(query))
+        if not query_terms:
+            return [0.0] * len(texts)
+        return [len(query_terms & set(lexical_tokens(text))) / len(query_terms) for text in texts]
+
+class TfidfClassifierScorer:
+    """Scores chunks by TF-IDF cosine with the question, plus agreement on the predicted document type
+
+    Uses the bundled vectorizer and naive Bayes classifier (requires scikit-learn, which is not
+    in requirements.txt). The vectorizer knows only 39 terms, so nearly every chunk has a cosine
+    of 0 and the ranking comes down to the document-type bonus; "lexical" or "cross-encoder"
+    rank far better.
+    """
+    
+    def __init__(self, vectorizer_path=VECTORIZER_PATH, classifier_path=CLASSIFIER_PATH):
+        # Both pickles ship with this repository, so they are trusted
+        with open(vectorizer_path, "rb") as vectorizer_file:
+            self.vectorizer = pickle.load(vectorizer_file)
+        with open(classifier_path, "rb") as classifier_file:
+            self.classifier = pickle.load(classifier_file)
+    
+    def score(self, query, texts):
+        features = self.vectorizer.transform([query] + list(texts))
+        # Rows are L2-normalized, so the dot product is the cosine
+        similarity = (features[1:] @ features[0].T).toarray().ravel()
+        classes = self.classifier.predict_proba(features)
+        agreement = classes[1:] @ classes[0]
+        return (similarity + CLASS_AGREEMENT_WEIGHT * agreement).tolist()
+
+class CrossEncoderScorer:
+    """Scores (question, chunk) pairs with a small cross-encoder on CPU (requires sentence-transformers)"""
+    
+    def __init__(self, model_name=RERANKER_MODEL):
+        from sentence_transformers import CrossEncoder
+        self.model = CrossEncoder(model_name, device="cpu")
+    
+    def score(self, query, texts):
+        return self.model.predict([(query, text) for text in texts], batch_size=16).tolist()
+
+RERANKERS = {
+    "lexical": LexicalOverlapScorer,
+    "tfidf": TfidfClassifierScorer,
+    "cross-encoder": CrossEncoderScorer,
+}
+
+@process_resource
+def get_reranker(name=RERANKER):
+    """Return the process-wide reranking scorer, or None when reranking is off"""
+    if name == "none":
+        return None
+    if name not in RERANKERS:
+        raise ValueError(f"Unknown reranker '{name}'. Choose one of: none, {', '.join(RERANKERS)}")
+    return RERANKERS[name]()
+
+@process_resource
+def get_rerank_executor():
+    """Return the process-wide thread pool that runs reranking scorers"""
+    return ThreadPoolExecutor(max_workers=4)
+
+def rerank(reranker, query, hits, top_k=RERANK_TOP_K, timeout=RERANK_TIMEOUT_SECONDS):
+    """Keep the top_k hits by reranker score, or the first top_k in retrieval order if scoring times out
+
+    Returns the kept hits and whether the reranker finished in time.
+    """
+    if len(hits) <= top_k:
+        return hits, True
+    future = get_rerank_executor().submit(reranker.score, query, [doc.page_content for _, doc in hits])
+    try:
+        scores = future.result(timeout=timeout)
+    except FuturesTimeoutError:
+        future.cancel()
+        return hits[:top_k], False
+    order = sorted(range(len(hits)), key=lambda i: scores[i], reverse=True)
+    return [hits[i] for i in order[:top_k]], True
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def pack_context(loaded_index, hits, query_vector, token_budget=CONTEXT_TOKEN_BUDGET):
+    """Pick the hits to send to the AI model by maximal marginal relevance, within a token budget
+
+    Relevance and redundancy are cosine similarities of the stored chunk vectors; chunks
+    nearly identical to one already picked (overlapping neighbours, repeated pages) are
+    dropped. Returns the picked hits in MMR order and the prompt tokens of all hits and of the pick.
+    """
+    candidate_tokens = sum(estimate_tokens(doc.page_content) for _, doc in hits)
+    if not hits:
+        return hits, candidate_tokens, 0
+    
+    vectors = loaded_index.vectors_for([cid for cid, _ in hits])
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    query = np.asarray(query_vector, dtype="float32")
+    relevance = vectors @ (query / max(np.linalg.norm(query), 1e-12))
+    
+    picked = []
+    packed_tokens = 0
+    redundancy = np.zeros(len(hits), dtype="float32")  # Highest similarity to any picked chunk
+    remaining = set(range(len(hits)))
+    while remaining:
+        best = max(remaining, key=lambda i: MMR_LAMBDA * relevance[i] - (1 - MMR_LAMBDA) * redundancy[i])
+        remaining.discard(best)
+        if picked and redundancy[best] >= NEAR_DUPLICATE_SIMILARITY:
+            continue
+        tokens = estimate_tokens(hits[best][1].page_content)
+        if picked and packed_tokens + tokens > token_budget:
+            continue
+        picked.append(best)
+        packed_tokens += tokens
+        redundancy = np.maximum(redundancy, vectors @ vectors[best])
+    return [hits[i] for i in picked], candidate_tokens, packed_tokens
+
+def format_citations(chunk_ids, chunk_table):
+    """Summarize which files and pages the context chunks came from"""
+    pages_by_file = OrderedDict()
+    for cid in chunk_ids:
+        row = chunk_table.row(cid)
+        if row is None:
+            continue
+        file_name = chunk_table.file_names[chunk_table.file[row]]
+        pages_by_file.setdefault(file_name, set()).update(
+            range(chunk_table.page_start[row], chunk_table.page_end[row] + 1)
+        )
+    
+    if not pages_by_file:
+        return ""
+    sources = [f"{name} (p. {', '.join(str(page) for page in sorted(pages))})" for name, pages in pages_by_file.items()]
+    return "📑 Sources: " + "; ".join(sources)
+
+def backend_settings():
+    """Settings of this backend that the UI shows or uses as defaults"""
+    return {
+        "embedding_backend": EMBEDDING_BACKEND,
+        "reranker": RERANKER,
+        "rerank_timeout_seconds": RERANK_TIMEOUT_SECONDS,
+        "answer_cache_enabled": ANSWER_CACHE_ENABLED,
+    }
+
+def start_answer(user_input, corpus_key, scope=None, reuse_answers=False, holder=None):
+    """Retrieve the context for a question and return an AnswerStream that generates the answer
+
+    holder, if given, marks the index as in use by that session (see IndexStore.acquire).
+    """
+    started = time.perf_counter()
+    try:
+        # Check if vector store exists
+        index_store = get_index_store()
+        index_path = index_store.path_for(corpus_key)
+        if not index_store.exists(corpus_key):
+            return AnswerStream.of_text("❌ Vector store not found. Please upload and process a PDF first.", started)
+        if holder is not None:
+            index_store.acquire(corpus_key, holder)
+        
+        # Initialize embeddings
+        embeddings = get_embeddings()
+        
+        # Load vector store (served from memory unless the index was rebuilt)
+        try:
+            loaded_index = get_vector_store_registry().get(index_path, embeddings)
+        except Exception as load_error:
+            return AnswerStream.of_text(
+                f"❌ Error loading vector store: {str(load_error)}. Please reprocess your PDF.", started
+            )
+        
+        # Plan every query variant up front: one embedding call, one batched search
+        reranker = get_reranker()
+        candidates = RERANK_CANDIDATES if reranker is not None else NUM_CONTEXT_DOCS
+        plan = plan_retrieval(loaded_index, embeddings, user_input, scope, candidates)
+        
+        # A near-identical question about the same documents skips retrieval and the AI model
+        answer_cache = get_answer_cache()
+        query_vector = plan.query_vectors[user_input]
+        if reuse_answers:
+            cached = answer_cache.lookup(corpus_key, scope, query_vector)
+            if cached is not None:
+                cached_answer, citations = cached
+                return AnswerStream.of_text(cached_answer, started, citations)
+        
+        hits, general_hits, top_similarity = retrieve(loaded_index, plan)
+        
+        # Re-score the wide candidate set and keep only the best few
+        reranked = None
+        if reranker is not None:
+            hits, reranked = rerank(reranker, user_input, hits)
+        
+        # Trim both candidate lists to what fits the prompt budget without repeating content
+        hits, candidate_tokens, packed_tokens = pack_context(loaded_index, hits, query_vector)
+        general_hits, _, _ = pack_context(loaded_index, general_hits, query_vector)
+        retrieved = time.perf_counter()
+        
+        # Get conversational chain
+        try:
+            chain = get_answer_chain()
+        except Exception as chain_error:
+            return AnswerStream.of_text(
+                f"❌ Error initializing AI model: {str(chain_error)}. Please check your API configuration.", started
+            )
+        chain_ready = time.perf_counter()
+    except Exception as e:
+        return AnswerStream.of_text(f"❌ Critical error: {str(e)}", started)
+    
+    def generate():
+        nonlocal hits
+        fallback_question = f"Based on the available information, what can you tell me about: {user_input}"
+        speculative = None
+        cancelled = stream.cancelled
+        try:
+            # Weak matches make a "not available" answer likely, so the broadened answer starts right away
+            if FALLBACK_STRATEGY == "speculative" and general_hits and top_similarity < SPECULATIVE_FALLBACK_SIMILARITY:
+                speculative = get_answer_executor().submit(
+                    collect_chain_answer, chain, [doc for _, doc in general_hits], fallback_question, cancelled
+                )
+                stream.speculated = True
+            
+            answer = ""
+            for piece in stream_chain(chain, [doc for _, doc in hits], user_input):
+                if cancelled.is_set():
+                    # Nobody is reading any more; don't cache the partial answer
+                    return answer
+                answer += piece
+                yield piece
+            
+            # If we still get a "not available" response, try a fallback approach
+            if "not available in the context" in answer.lower() or "cannot find" in answer.lower():
+                # Try a more general search
+                if general_hits:
+                    yield "\n\n🔄 Searching the documents more broadly...\n\n"
+                    if speculative is not None:
+                        fallback_answer = speculative.result()
+                        yield fallback_answer
+                    else:
+                        fallback_answer = ""
+                        for piece in stream_chain(chain, [doc for _, doc in general_hits], fallback_question):
+                            fallback_answer += piece
+                            yield piece
+                    if "not available" not in fallback_answer.lower():
+                        answer = fallback_answer
+                        hits = general_hits
+                        stream.winner = "fallback"
+            
+            # Cite the pages the answer was drawn from; they are shown next to the answer, not stored,
+            # exported or read aloud with it
+            stream.citations = format_citations([cid for cid, _ in hits], loaded_index.chunk_table)
+            
+            answer_cache.store(corpus_key, scope, user_input, query_vector, answer, stream.citations)
+            return answer
+            
+        except Exception as chain_error:
+            message = f"❌ Error processing question: {str(chain_error)}"
+            yield message
+            return message
+        finally:
+            # The primary answer was good enough (or failed): stop generating the other one
+            cancelled.set()
+            if speculative is not None:
+                speculative.cancel()
+    
+    stream = AnswerStream(generate(), started)
+    stream.timings = {"retrieval": retrieved - started, "chain_setup": chain_ready - retrieved}
+    stream.context_tokens = (candidate_tokens, packed_tokens)
+    stream.reranked = reranked
+    return stream
+
+def process_user_message(user_input, corpus_key, scope=None, reuse_answers=False, holder=None):
+    """Answer a question in one piece, without streaming
+
+    Returns the finished AnswerStream, whose answer, citations and stats are all filled in.
+    """
+    stream = start_answer(user_input, corpus_key, scope, reuse_answers, holder)
+    for _ in stream:
+        pass
+    return stream
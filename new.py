@@ -1,20 +1,22 @@
 import os
 import streamlit as st
-from PyPDF2 import PdfReader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_google_genai import GoogleGenerativeAIEmbeddings, ChatGoogleGenerativeAI
-from langchain_community.vectorstores import FAISS
-from langchain.chains.question_answering import load_qa_chain
-from langchain.prompts import PromptTemplate
 from dotenv import load_dotenv
-import google.generativeai as genai
-from gtts import gTTS
 import tempfile
-import re
+import time
+import uuid
+import json
+import math
+from array import array
+from collections import deque
+from speech import AudioCache, SpeechSynthesizer
+from qa_api import IngestionError, EmbeddingError, LocalBackend, ServiceClient, compute_upload_key
 
 # Load environment variables
 load_dotenv()
 
+# Start of this script run, for the script time shown in the sidebar
+script_started = time.perf_counter()
+
 # Language mapping for gTTS (text-to-speech)
 LANGUAGE_MAPPING = {
     "English": "en",
@@ -31,19 +33,55 @@ LANGUAGE_MAPPING = {
     "Italian": "it",
 }
 
-# Configure Google API
-try:
-    api_key = os.getenv("GOOGLE_API_KEY")
-    if not api_key:
-        st.error("🚨 GOOGLE_API_KEY not found! Please set your API key in environment variables.")
+# Text-to-speech audio cache and synthesis
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", "tts_cache")
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+TTS_PREFETCH_ENABLED = os.getenv("TTS_PREFETCH_ENABLED", "false").lower() in ("1", "true", "yes")
+
+# Chat history: recent turns stay in memory, older ones spill to disk; the view is paginated
+CHAT_MEMORY_TURNS = 50
+CHAT_SPILL_DIR = os.getenv("CHAT_SPILL_DIR", os.path.join(tempfile.gettempdir(), "pdf_chatbot_history"))
+CHAT_SPILL_TTL_SECONDS = 24 * 60 * 60  # Spill files of abandoned sessions are removed after this
+HISTORY_PAGE_SIZE = 10
+
+# Question answering runs in the HTTP service (service.py) when its URL is set, otherwise in this process
+QA_SERVICE_URL = os.getenv("QA_SERVICE_URL", "").rstrip("/")
+QA_SERVICE_TIMEOUT_SECONDS = float(os.getenv("QA_SERVICE_TIMEOUT_SECONDS", "300"))
+
+# Configure Google API (only needed when answering in this process)
+if not QA_SERVICE_URL:
+    try:
+        import google.generativeai as genai
+        
+        api_key = os.getenv("GOOGLE_API_KEY")
+        if not api_key:
+            st.error("🚨 GOOGLE_API_KEY not found! Please set your API key in environment variables.")
+            st.stop()
+        
+        genai.configure(api_key=api_key)
+        # Remove the success message that creates unwanted box
+        # st.success("✅ Google API configured successfully!")
+    except Exception as e:
+        st.error(f"🚨 API Configuration Error: {str(e)}")
         st.stop()
-    
-    genai.configure(api_key=api_key)
-    # Remove the success message that creates unwanted box
-    # st.success("✅ Google API configured successfully!")
-except Exception as e:
-    st.error(f"🚨 API Configuration Error: {str(e)}")
-    st.stop()
+
+@st.cache_resource
+def get_backend():
+    """Return the QA service client when a service URL is configured, otherwise the in-process backend"""
+    return ServiceClient(QA_SERVICE_URL, QA_SERVICE_TIMEOUT_SECONDS) if QA_SERVICE_URL else LocalBackend()
+
+@st.cache_resource
+def get_backend_settings():
+    """Settings of the backend answering questions, fetched once per process"""
+    return get_backend().settings()
+
+# Shown when the QA service can't be reached
+UNKNOWN_BACKEND_SETTINGS = {
+    "embedding_backend": "unknown",
+    "reranker": "unknown",
+    "rerank_timeout_seconds": 0.0,
+    "answer_cache_enabled": False,
+}
 
 headers = {
     "authorization": os.getenv("GOOGLE_API_KEY"),
@@ -722,6 +760,69 @@ with st.sidebar:
     if "chat_history" in st.session_state and st.session_state.chat_history:
         st.metric("💬 Questions Asked", len(st.session_state.chat_history))
     
+    try:
+        backend_settings = get_backend_settings()
+    except Exception as settings_error:
+        st.error(f"❌ QA service unavailable: {str(settings_error)}")
+        backend_settings = UNKNOWN_BACKEND_SETTINGS
+    
+    # Reuse stored answers for near-identical questions about the same documents
+    reuse_answers = st.toggle(
+        "♻️ Reuse answers to similar questions",
+        value=backend_settings["answer_cache_enabled"],
+        help="Skips the AI model when a question is almost identical to one already answered for these documents"
+    )
+    
+    # Synthesize audio for each new answer in the background so Listen plays at once
+    prefetch_audio = st.toggle(
+        "🎧 Prepare audio for new answers",
+        value=TTS_PREFETCH_ENABLED,
+        help="Starts text-to-speech for the latest answer as soon as it arrives, in the selected language"
+    )
+    
+    st.caption(f"🧬 Embedding backend: {backend_settings['embedding_backend']}")
+    
+    index_report = st.session_state.get("index_report")
+    if index_report:
+        st.caption(f"🗂️ Vector index: {index_report['index_type']} ({index_report['vectors']:,} vectors, "
+                   f"{index_report['bytes'] / (1024 * 1024):.1f} MB)")
+        if index_report.get("sweep"):
+            with st.expander("📈 Recall vs. latency"):
+                st.caption(f"Exact search: {index_report['exact_ms_per_query']:.2f} ms/query; "
+                           f"configured {index_report['setting']} = {index_report['configured']}")
+                st.dataframe(index_report["sweep"], hide_index=True)
+    
+    answer_timings = st.session_state.get("answer_timings")
+    if answer_timings and answer_timings["first_token"] is not None:
+        with st.expander("⏱️ Performance"):
+            st.metric("⚡ Time to First Token", f"{answer_timings['first_token']:.2f} s",
+                      help="From pressing Ask until the first words of the last answer appeared")
+            if "chain_setup" in answer_timings:
+                st.caption(f"Retrieval: {answer_timings['retrieval'] * 1000:.0f} ms · "
+                           f"AI model setup: {answer_timings['chain_setup'] * 1000:.1f} ms")
+            context_tokens = st.session_state.get("context_tokens")
+            if context_tokens:
+                st.caption(f"✂️ Context: {context_tokens[1]:,} of {context_tokens[0]:,} retrieved tokens sent "
+                           f"({context_tokens[0] - context_tokens[1]:,} saved)")
+            rerank_runs = st.session_state.get("rerank_runs")
+            if rerank_runs:
+                st.caption(f"🎯 Reranker ({backend_settings['reranker']}): {rerank_runs['finished']} finished, "
+                           f"{rerank_runs['timed_out']} past the {backend_settings['rerank_timeout_seconds']:g} s ceiling")
+            speculative_wins = st.session_state.get("speculative_wins")
+            if speculative_wins:
+                st.caption(f"🏁 Speculative fallbacks: first answer kept {speculative_wins['primary']}×, "
+                           f"broadened answer kept {speculative_wins['fallback']}×")
+    
+    script_times = st.session_state.get("script_times")
+    if script_times:
+        st.caption("🖥️ Last script runs: " + " · ".join(f"{section} {seconds * 1000:.0f} ms"
+                                                          for section, seconds in script_times.items()))
+    
+    cache_stats = st.session_state.get("embedding_cache_stats")
+    if cache_stats and cache_stats["hits"] + cache_stats["misses"]:
+        st.metric("🧠 Embedding Cache Hit Rate", f"{cache_stats['hit_rate']:.0%}",
+                  help=f"{cache_stats['hits']} hits / {cache_stats['misses']} misses since the server started")
+    
     # Info section
     st.markdown("---")
     st.markdown("### ℹ️ Information")
@@ -737,387 +838,382 @@ uploaded_files = st.file_uploader(
     help="Upload one or more PDF files to analyze"
 )
 
-def extract_text_from_pdfs(files):
-    """Extract text from uploaded PDF files"""
-    text = ""
-    total_pages = 0
-    
-    try:
-        for file_idx, file in enumerate(files):
-            # Reset file pointer to beginning
-            file.seek(0)
-            
-            try:
-                pdf_reader = PdfReader(file)
-                file_pages = len(pdf_reader.pages)
-                total_pages += file_pages
-                
-                for page_num, page in enumerate(pdf_reader.pages):
-                    try:
-                        page_text = page.extract_text()
-                        if page_text.strip():  # Only add non-empty pages
-                            text += f"\n\n--- FILE: {file.name} | PAGE {page_num + 1} ---\n{page_text}"
-                            
-                    except Exception as page_error:
-                        continue
-                        
-            except Exception as file_error:
-                continue
-                
-        if not text.strip():
-            st.error("❌ No text could be extracted from the uploaded PDFs. Please check if they contain readable text.")
-            return None
-            
-        return text
-        
-    except Exception as e:
-        st.error(f"❌ Critical error during PDF processing: {str(e)}")
-        return None
-
-def preprocess_text(text):
-    # Improved text preprocessing
-    # Remove extra whitespace but preserve paragraph breaks
-    text = re.sub(r'\n\s*\n', '\n\n', text)  # Normalize paragraph breaks
-    text = re.sub(r'[ \t]+', ' ', text)  # Normalize spaces and tabs
-    text = text.strip()
-    return text
-
-def create_vector_store(text):
-    """Create FAISS vector store from text"""
-    if not text or not text.strip():
-        st.error("❌ No text provided for vector store creation!")
-        return 0
-        
-    try:
-        with st.spinner("🔄 Creating AI embeddings..."):
-            # Improved text splitting with better parameters
-            text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=1500,  # Smaller chunks for better precision
-                chunk_overlap=300,  # More overlap for better context preservation
-                length_function=len,
-                separators=["\n\n", "\n", ". ", " ", ""]  # Better separation logic
-            )
-            
-            text_chunks = text_splitter.split_text(text)
-            
-            # Filter out very short chunks that might not be useful
-            text_chunks = [chunk for chunk in text_chunks if len(chunk.strip()) > 50]
-            
-            if not text_chunks:
-                st.error("❌ No valid text chunks created! Please check your PDF content.")
-                return 0
-            
-            # Initialize embeddings with error handling
-            try:
-                embeddings = GoogleGenerativeAIEmbeddings(
-                    model="models/embedding-001",
-                    google_api_key=os.getenv("GOOGLE_API_KEY")
-                )
-                
-                vector_store = FAISS.from_texts(text_chunks, embedding=embeddings)
-                vector_store.save_local("faiss_index")
-                
-                # Return the actual chunk count
-                return len(text_chunks)
-                
-            except Exception as embedding_error:
-                st.error(f"❌ Error creating embeddings: {str(embedding_error)}")
-                st.error("🔍 This might be due to API key issues or network problems.")
-                return 0
-                
-    except Exception as e:
-        st.error(f"❌ Error in vector store creation: {str(e)}")
-        return 0
-
-def get_conversational_chain():
-    """Create conversational chain with error handling"""
-    try:
-        # Enhanced prompt template with better instructions
-        prompt_template = """
-        You are an intelligent AI assistant analyzing a document. Use the provided context to answer the question as comprehensively as possible.
-
-        INSTRUCTIONS:
-        1. If you find relevant information in the context, provide a detailed and helpful answer
-        2. If the exact answer isn't available, try to provide related information that might be helpful
-        3. If you can make reasonable inferences from the available information, do so while indicating they are inferences
-        4. Only say "Answer is not available in the context" if there is absolutely no relevant information
-        5. Be conversational and helpful in your tone
-        6. If appropriate, suggest what additional information might be needed
-
-        Context:
-        {context}
-
-        Question: {question}
+def set_active_corpus(result):
+    """Point this session at the index described by an ingestion result, releasing the previous one"""
+    backend = get_backend()
+    corpus_key = result["corpus_key"]
+    session_id = st.session_state.session_id
+    previous_key = st.session_state.get("corpus_key")
+    if previous_key and previous_key != corpus_key:
+        backend.release(previous_key, session_id)
+    backend.acquire(corpus_key, session_id)
+    
+    st.session_state.corpus_key = corpus_key
+    st.session_state.chunk_count = result["chunk_count"]
+    st.session_state.index_report = result["index_report"]
+    st.session_state.embedding_cache_stats = result["embedding_cache_stats"]
+    st.session_state.vector_store_ready = True
 
-        Helpful Answer:
-        """
-        
-        # Initialize model with error handling
-        model = ChatGoogleGenerativeAI(
-            model="gemini-2.0-flash-exp", 
-            temperature=0.4,
-            google_api_key=os.getenv("GOOGLE_API_KEY")
-        )
-        
-        prompt = PromptTemplate(template=prompt_template, input_variables=["context", "question"])
-        chain = load_qa_chain(model, chain_type="stuff", prompt=prompt)
-        
-        return chain
-        
-    except Exception as e:
-        st.error(f"❌ Error creating conversational chain: {str(e)}")
-        return None
+@st.cache_resource
+def get_speech_synthesizer():
+    """Return the process-wide speech synthesizer and its audio cache"""
+    return SpeechSynthesizer(AudioCache(TTS_CACHE_DIR, TTS_CACHE_MAX_BYTES))
 
-def enhance_query(query):
-    """Enhance user query with synonyms and related terms"""
-    # Simple query enhancement - you can make this more sophisticated
-    enhanced_terms = []
-    
-    # Add the original query
-    enhanced_terms.append(query)
-    
-    # Add variations (you can expand this with a proper thesaurus)
-    common_synonyms = {
-        "summary": ["overview", "abstract", "conclusion", "main points"],
-        "benefits": ["advantages", "positives", "pros", "value"],
-        "problems": ["issues", "challenges", "difficulties", "concerns"],
-        "cost": ["price", "expense", "budget", "financial"],
-        "process": ["procedure", "method", "steps", "approach"],
-        "result": ["outcome", "finding", "conclusion", "effect"]
-    }
-    
-    query_lower = query.lower()
-    for key, synonyms in common_synonyms.items():
-        if key in query_lower:
-            enhanced_terms.extend(synonyms)
-    
-    return " ".join(enhanced_terms)
-
-def process_user_message(user_input):
-    """Process user message with enhanced error handling"""
-    try:
-        with st.spinner("🤔 Processing your question..."):
-            # Check if vector store exists
-            if not os.path.exists("faiss_index"):
-                return "❌ Vector store not found. Please upload and process a PDF first."
-            
-            # Initialize embeddings
-            embeddings = GoogleGenerativeAIEmbeddings(
-                model="models/embedding-001",
-                google_api_key=os.getenv("GOOGLE_API_KEY")
-            )
-            
-            # Load vector store
-            try:
-                vector_store = FAISS.load_local("faiss_index", embeddings, allow_dangerous_deserialization=True)
-            except Exception as load_error:
-                return f"❌ Error loading vector store: {str(load_error)}. Please reprocess your PDF."
-            
-            # Enhanced query
-            enhanced_query = enhance_query(user_input)
-            
-            # Get more documents for better context (fixed at 6)
-            num_docs = 6
-            docs = vector_store.similarity_search(enhanced_query, k=num_docs)
-        
-            # Also try with the original query if enhanced query doesn't yield good results
-            if len(docs) < num_docs:
-                additional_docs = vector_store.similarity_search(user_input, k=num_docs)
-                # Combine and deduplicate
-                all_docs = docs + additional_docs
-                seen_content = set()
-                unique_docs = []
-                for doc in all_docs:
-                    if doc.page_content not in seen_content:
-                        unique_docs.append(doc)
-                        seen_content.add(doc.page_content)
-                docs = unique_docs[:num_docs]
-            
-            # If still no good matches, try with more relaxed search
-            if len(docs) < 3:
-                # Try searching with individual words from the query
-                words = user_input.split()
-                for word in words:
-                    if len(word) > 3:  # Only search meaningful words
-                        word_docs = vector_store.similarity_search(word, k=2)
-                        docs.extend(word_docs)
-            
-            # Get conversational chain
-            chain = get_conversational_chain()
-            if not chain:
-                return "❌ Error initializing AI model. Please check your API configuration."
-            
-            try:
-                response = chain({"input_documents": docs, "question": user_input}, return_only_outputs=True)
-                answer = response["output_text"]
-                
-                # If we still get a "not available" response, try a fallback approach
-                if "not available in the context" in answer.lower() or "cannot find" in answer.lower():
-                    # Try a more general search
-                    general_docs = vector_store.similarity_search(user_input, k=10)
-                    if general_docs:
-                        fallback_response = chain({"input_documents": general_docs, "question": f"Based on the available information, what can you tell me about: {user_input}"}, return_only_outputs=True)
-                        fallback_answer = fallback_response["output_text"]
-                        if "not available" not in fallback_answer.lower():
-                            answer = fallback_answer
-                
-                return answer
-                
-            except Exception as chain_error:
-                return f"❌ Error processing question: {str(chain_error)}"
-                
-    except Exception as e:
-        return f"❌ Critical error: {str(e)}"
+def sync_audio_prefetch(enabled, language_code):
+    """Keep background synthesis pointed at the newest answer in the selected language"""
+    prefetch = st.session_state.get("tts_prefetch")
+    history = st.session_state.chat_history
+    target = history[-1][1] if enabled and history and not history[-1][1].startswith("❌") else None
+    
+    # A newer answer, another language or switching prefetch off makes the running job useless
+    if prefetch is not None and (target is None or not prefetch.matches(target, language_code)):
+        prefetch.cancel()
+        del st.session_state.tts_prefetch
+        prefetch = None
+    if target is not None and prefetch is None:
+        st.session_state.tts_prefetch = get_speech_synthesizer().prefetch(target, language_code)
 
 def speak_text(text, language_code="en"):
     """Convert text to speech and play it"""
     try:
-        tts = gTTS(text=text, lang=language_code)
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".mp3")
-        tts.save(temp_file.name)
-        st.audio(temp_file.name, format="audio/mp3", autoplay=True)
+        audio = None
+        prefetch = st.session_state.get("tts_prefetch")
+        if prefetch is not None and prefetch.matches(text, language_code):
+            # Waits only for whatever part of the synthesis is still running
+            try:
+                audio = prefetch.future.result()
+            except Exception:
+                audio = None  # Synthesize again below and report any error from there
+        if audio is None:
+            audio = get_speech_synthesizer().audio_for(text, language_code)
+        st.audio(audio, format="audio/mp3", autoplay=True)
         return True
     except Exception as e:
         st.error(f"❌ Text-to-speech error: {str(e)}")
         return False
 
+class ChatHistory:
+    """(question, answer, citations) turns of one session, holding only the most recent in memory
+
+    Older turns are appended to a JSON-lines spill file, and the offset of each line is
+    kept so any page of the history can be read back with a single seek.
+    """
+    
+    def __init__(self, spill_path, max_memory_turns=CHAT_MEMORY_TURNS):
+        self.spill_path = spill_path
+        self.max_memory_turns = max_memory_turns
+        self._recent = deque()
+        self._spilled_offsets = array("q")
+    
+    def __len__(self):
+        return len(self._spilled_offsets) + len(self._recent)
+    
+    def __bool__(self):
+        return len(self) > 0
+    
+    def append(self, turn):
+        self._recent.append(tuple(turn))
+        if len(self._recent) > self.max_memory_turns:
+            with open(self.spill_path, "ab") as spill_file:
+                self._spilled_offsets.append(spill_file.tell())
+                spill_file.write(json.dumps(self._recent.popleft()).encode("utf-8") + b"\n")
+    
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("chat history index out of range")
+        return self.slice(index, index + 1)[0]
+    
+    def slice(self, start, stop):
+        """Turns start to stop (exclusive), oldest first"""
+        spilled = len(self._spilled_offsets)
+        turns = []
+        if start < spilled:
+            with open(self.spill_path, "rb") as spill_file:
+                spill_file.seek(self._spilled_offsets[start])
+                for _ in range(min(stop, spilled) - start):
+                    turns.append(tuple(json.loads(spill_file.readline())))
+        recent_start, recent_stop = max(start - spilled, 0), max(stop - spilled, 0)
+        turns.extend(self._recent[i] for i in range(recent_start, min(recent_stop, len(self._recent))))
+        return turns
+    
+    def __iter__(self):
+        if self._spilled_offsets:
+            with open(self.spill_path, "rb") as spill_file:
+                for _ in range(len(self._spilled_offsets)):
+                    yield tuple(json.loads(spill_file.readline()))
+        yield from list(self._recent)
+    
+    def clear(self):
+        self._recent.clear()
+        self._spilled_offsets = array("q")
+        try:
+            os.remove(self.spill_path)
+        except OSError:
+            pass
+
+@st.cache_resource
+def get_chat_spill_dir():
+    """Create the chat spill directory, removing files left by sessions that ended long ago"""
+    os.makedirs(CHAT_SPILL_DIR, exist_ok=True)
+    for name in os.listdir(CHAT_SPILL_DIR):
+        path = os.path.join(CHAT_SPILL_DIR, name)
+        try:
+            if os.path.getmtime(path) < time.time() - CHAT_SPILL_TTL_SECONDS:
+                os.remove(path)
+        except OSError:
+            continue
+    return CHAT_SPILL_DIR
+
+# Identifies this session when it holds a reference to a shared index
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+
 # Initialize chat history
 if "chat_history" not in st.session_state:
-    st.session_state.chat_history = []
+    st.session_state.chat_history = ChatHistory(
+        os.path.join(get_chat_spill_dir(), f"{st.session_state.session_id}.jsonl")
+    )
 
 # PDF Processing
 if uploaded_files:
-    # Extract text from PDFs
-    raw_text = extract_text_from_pdfs(uploaded_files)
+    ingestion_key = compute_upload_key(uploaded_files)
     
-    if raw_text:
-        # Preprocess text
-        processed_text = preprocess_text(raw_text)
-        
-        if processed_text:
-            # Create vector store and get chunk count
-            chunk_count = create_vector_store(processed_text)
-            
-            if chunk_count > 0:
-                # Store the chunk count and set ready flag
-                st.session_state.chunk_count = chunk_count
-                st.session_state.vector_store_ready = True
-                st.success(f"✅ PDFs processed successfully!")
-            else:
-                st.error("❌ Failed to create vector store. Please try again or check your API configuration.")
-        else:
-            st.error("❌ Failed to preprocess text. Please check your PDF files.")
+    if st.session_state.get("upload_key") == ingestion_key and st.session_state.get("vector_store_ready"):
+        # Same uploads as the last run: reuse the existing index without re-parsing or re-embedding
+        st.success("✅ PDFs processed successfully!")
     else:
-        st.error("❌ Failed to extract text from PDFs. Please ensure your PDFs contain readable text.")
+        # Shares an index already built for these documents, or updates the previous one incrementally
+        try:
+            with st.spinner("🔄 Creating AI embeddings..."):
+                progress = st.empty()
+                result = get_backend().ingest(
+                    uploaded_files,
+                    base_key=st.session_state.get("corpus_key"),
+                    on_progress=lambda message: progress.caption(f"🔄 {message}")
+                )
+                progress.empty()
+            set_active_corpus(result)
+            st.session_state.upload_key = ingestion_key
+            st.success("✅ PDFs processed successfully!")
+        except IngestionError as ingestion_error:
+            st.error(f"❌ {str(ingestion_error)}")
+        except EmbeddingError as embedding_error:
+            st.error(f"❌ Error creating embeddings: {str(embedding_error)}")
+            st.error("🔍 This might be due to API key issues or network problems.")
+        except Exception as e:
+            st.error(f"❌ Error in vector store creation: {str(e)}")
+            st.error("❌ Failed to create vector store. Please try again or check your API configuration.")
 
 # Chat Interface
 st.markdown("### 💬 Ask Questions")
 
-# Create columns for better layout
-col1, col2 = st.columns([4, 1])
-
-with col1:
-    user_input = st.text_input(
-        "What would you like to know about your document?",
-        placeholder="e.g., What is the main topic of this document?",
-        label_visibility="collapsed"
-    )
+# Optional search scope: restrict retrieval to some files or a page range
+search_scope = None
+if st.session_state.get("vector_store_ready"):
+    try:
+        # Files and pages only change with the corpus, so they're fetched once per corpus
+        corpus = st.session_state.get("corpus_description")
+        if corpus is None or corpus["corpus_key"] != st.session_state.corpus_key:
+            corpus = get_backend().describe_corpus(st.session_state.corpus_key)
+            st.session_state.corpus_description = corpus
+        file_names = [file["name"] for file in corpus["files"]]
+        
+        with st.expander("🔎 Search scope"):
+            selected_files = st.multiselect(
+                "Files",
+                file_names,
+                help="Leave empty to search all files"
+            )
+            max_page = corpus["max_page"]
+            page_col1, page_col2 = st.columns(2)
+            with page_col1:
+                first_page = st.number_input("From page", min_value=1, max_value=max_page, value=1)
+            with page_col2:
+                last_page = st.number_input("To page", min_value=1, max_value=max_page, value=max_page)
+        
+        if selected_files or first_page > 1 or last_page < max_page:
+            file_keys = tuple(corpus["files"][file_names.index(name)]["file_key"] for name in selected_files) or None
+            search_scope = (file_keys, (first_page, last_page))
+    except Exception:
+        search_scope = None
 
-with col2:
-    ask_button = st.button("Ask", type="primary", use_container_width=True)
+def record_script_time(section, started):
+    """Remember how long the last run of a page section took, for the sidebar"""
+    st.session_state.setdefault("script_times", {})[section] = time.perf_counter() - started
 
-# Process question
-if ask_button and user_input:
-    if "vector_store_ready" not in st.session_state:
-        st.warning("⚠️ Please upload and process a PDF first!")
-    else:
-        # Get the response
-        response = process_user_message(user_input)
+@st.fragment
+def conversation_section(search_scope, reuse_answers, prefetch_audio, language):
+    """Question box, answer streaming and history; asking a question reruns only this section"""
+    started = time.perf_counter()
+    try:
+        # Create columns for better layout
+        col1, col2 = st.columns([4, 1])
         
-        # Store the response
-        st.session_state.chat_history.append((user_input, response))
-
-# Display chat history
-if st.session_state.chat_history:
-    st.markdown("### 💭 Conversation History")
-    
-    for i, (question, answer) in enumerate(reversed(st.session_state.chat_history)):
-        # User message
-        st.markdown(f'''
-        <div class="user-message">
-            <strong>You:</strong> {question}
-        </div>
-        ''', unsafe_allow_html=True)
+        with col1:
+            user_input = st.text_input(
+                "What would you like to know about your document?",
+                placeholder="e.g., What is the main topic of this document?",
+                label_visibility="collapsed"
+            )
         
-        # Bot message
-        st.markdown(f'''
-        <div class="bot-message">
-            <strong>AI:</strong> {answer}
-        </div>
-        ''', unsafe_allow_html=True)
+        with col2:
+            ask_button = st.button("Ask", type="primary", use_container_width=True)
         
-        if i < len(st.session_state.chat_history) - 1:
-            st.markdown("---")
-
-# Feature buttons
-if st.session_state.chat_history:
-    st.markdown("### 🛠️ Actions")
-    
-    col1, col2, col3 = st.columns(3)
-    
-    with col1:
-        if st.button("🔊 Listen", use_container_width=True):
-            try:
-                # Get the language code for the selected language
-                lang_code = LANGUAGE_MAPPING[language]
-                response_text = st.session_state.chat_history[-1][1]
+        # Process question
+        if ask_button and user_input:
+            if "vector_store_ready" not in st.session_state:
+                st.warning("⚠️ Please upload and process a PDF first!")
+            else:
+                # Stream the answer as it is generated; once complete it is shown with the rest of the history
+                with st.spinner("🤔 Processing your question..."):
+                    answer_stream = get_backend().start_answer(
+                        user_input, st.session_state.corpus_key, search_scope, reuse_answers, st.session_state.session_id
+                    )
+                live_answer = st.empty()
+                with live_answer.container():
+                    with st.chat_message("user"):
+                        st.markdown(user_input)
+                    with st.chat_message("assistant"):
+                        st.write_stream(answer_stream)
+                live_answer.empty()
+                
+                # Store the response and go back to the page with the newest turns
+                st.session_state.chat_history.append((user_input, answer_stream.answer, answer_stream.citations))
+                st.session_state.history_page = 0
+                st.session_state.answer_timings = dict(answer_stream.timings, first_token=answer_stream.first_piece_seconds)
+                if answer_stream.context_tokens:
+                    st.session_state.context_tokens = answer_stream.context_tokens
+                if answer_stream.reranked is not None:
+                    rerank_runs = st.session_state.setdefault("rerank_runs", {"finished": 0, "timed_out": 0})
+                    rerank_runs["finished" if answer_stream.reranked else "timed_out"] += 1
+                if answer_stream.speculated:
+                    speculative_wins = st.session_state.setdefault("speculative_wins", {"primary": 0, "fallback": 0})
+                    speculative_wins[answer_stream.winner] += 1
                 
-                # Use the speak_text function with selected language
-                if speak_text(response_text, lang_code):
-                    st.success(f"🎵 Audio ready in {language}")
-                else:
-                    st.error(f"Audio failed for {language}")
+                # The actions and feedback sections only exist once there is history: rerun the whole page for them
+                if len(st.session_state.chat_history) == 1:
+                    st.rerun()
+        
+        # Start (or retarget) background audio for the newest answer
+        sync_audio_prefetch(prefetch_audio, LANGUAGE_MAPPING[language])
+        
+        # Display chat history, one page at a time (newest first)
+        if st.session_state.chat_history:
+            st.markdown("### 💭 Conversation History")
+            
+            history = st.session_state.chat_history
+            page_count = math.ceil(len(history) / HISTORY_PAGE_SIZE)
+            page = min(st.session_state.get("history_page", 0), page_count - 1)
+            stop = len(history) - page * HISTORY_PAGE_SIZE
+            start = max(0, stop - HISTORY_PAGE_SIZE)
+            
+            for question, answer, citations in reversed(history.slice(start, stop)):
+                with st.chat_message("user"):
+                    st.markdown(question)
+                with st.chat_message("assistant"):
+                    st.markdown(answer)
+                    if citations:
+                        st.caption(citations)
+            
+            if page_count > 1:
+                nav_col1, nav_col2, nav_col3 = st.columns([1, 2, 1])
+                with nav_col1:
+                    if st.button("⬅️ Newer", disabled=page == 0, use_container_width=True):
+                        st.session_state.history_page = page - 1
+                        st.rerun(scope="fragment")
+                with nav_col2:
+                    st.caption(f"Page {page + 1} of {page_count} · questions {start + 1}–{stop} of {len(history)}")
+                with nav_col3:
+                    if st.button("Older ➡️", disabled=page >= page_count - 1, use_container_width=True):
+                        st.session_state.history_page = page + 1
+                        st.rerun(scope="fragment")
+    finally:
+        record_script_time("ask", started)
+
+@st.fragment
+def actions_section(language):
+    """Listen, Export and Clear buttons; Listen and Export rerun only this section"""
+    started = time.perf_counter()
+    try:
+        if st.session_state.chat_history:
+            st.markdown("### 🛠️ Actions")
+            
+            col1, col2, col3 = st.columns(3)
+            
+            with col1:
+                if st.button("🔊 Listen", use_container_width=True):
+                    try:
+                        # Get the language code for the selected language
+                        lang_code = LANGUAGE_MAPPING[language]
+                        response_text = st.session_state.chat_history[-1][1]
+                        
+                        # Use the speak_text function with selected language
+                        if speak_text(response_text, lang_code):
+                            st.success(f"🎵 Audio ready in {language}")
+                        else:
+                            st.error(f"Audio failed for {language}")
                     
-            except Exception as e:
-                st.error(f"Audio failed: {str(e)}")
-    
-    with col2:
-        if st.button("💾 Export", use_container_width=True):
-            chat_text = "\n".join([f"Q: {chat[0]}\nA: {chat[1]}\n{'-'*50}\n" for chat in st.session_state.chat_history])
-            st.download_button(
-                "📥 Download", 
-                chat_text, 
-                file_name="chat_history.txt",
-                mime="text/plain",
-                use_container_width=True
-            )
-    
-    with col3:
-        if st.button("🗑️ Clear", use_container_width=True):
-            st.session_state.chat_history = []
-            if "vector_store_ready" in st.session_state:
-                del st.session_state.vector_store_ready
-            if "chunk_count" in st.session_state:
-                del st.session_state.chunk_count
-            st.rerun()
+                    except Exception as e:
+                        st.error(f"Audio failed: {str(e)}")
+            
+            with col2:
+                if st.button("💾 Export", use_container_width=True):
+                    chat_text = "\n".join([f"Q: {chat[0]}\nA: {chat[1]}\n{'-'*50}\n" for chat in st.session_state.chat_history])
+                    st.download_button(
+                        "📥 Download", 
+                        chat_text, 
+                        file_name="chat_history.txt",
+                        mime="text/plain",
+                        use_container_width=True
+                    )
+            
+            with col3:
+                if st.button("🗑️ Clear", use_container_width=True):
+                    st.session_state.chat_history.clear()
+                    st.session_state.history_page = 0
+                    if "vector_store_ready" in st.session_state:
+                        del st.session_state.vector_store_ready
+                    if "chunk_count" in st.session_state:
+                        del st.session_state.chunk_count
+                    if "corpus_key" in st.session_state:
+                        get_backend().release(st.session_state.corpus_key, st.session_state.session_id)
+                        del st.session_state.corpus_key
+                    st.session_state.pop("upload_key", None)
+                    st.rerun()
+    finally:
+        record_script_time("actions", started)
+
+@st.fragment
+def feedback_section():
+    """Feedback radio, rerunning only this section when changed"""
+    started = time.perf_counter()
+    try:
+        if st.session_state.chat_history:
+            st.markdown("---")
+            st.markdown("### ⭐ Feedback")
+            
+            col1, col2 = st.columns([2, 3])
+            
+            with col1:
+                feedback = st.radio(
+                    "How was the response?",
+                    ["⭐ Excellent", "👍 Good", "👎 Needs improvement"],
+                    horizontal=True
+                )
+            
+            with col2:
+                if feedback:
+                    st.success(f"✅ Thank you for the feedback: {feedback}")
+    finally:
+        record_script_time("feedback", started)
 
+conversation_section(search_scope, reuse_answers, prefetch_audio, language)
+# Feature buttons
+actions_section(language)
 # Feedback section
-if st.session_state.chat_history:
-    st.markdown("---")
-    st.markdown("### ⭐ Feedback")
-    
-    col1, col2 = st.columns([2, 3])
-    
-    with col1:
-        feedback = st.radio(
-            "How was the response?",
-            ["⭐ Excellent", "👍 Good", "👎 Needs improvement"],
-            horizontal=True
-        )
-    
-    with col2:
-        if feedback:
-            st.success(f"✅ Thank you for the feedback: {feedback}")
+feedback_section()
 
 # Enhanced Footer with beautiful typography
 st.markdown("---")
@@ -1135,3 +1231,5 @@ st.markdown(
     </div>
     """, 
     unsafe_allow_html=True)
+
+record_script_time("full page", script_started)
@@ -0,0 +1,22 @@
+# Page-level PDF text extraction.
+# Kept outside new.py so worker processes can import it without running the Streamlit app.
+from PyPDF2 import PdfReader
+
+
+def count_pages(path):
+    """Return the number of pages in a PDF file"""
+    return len(PdfReader(path).pages)
+
+
+def extract_page_range(path, start, stop):
+    """Extract the text of pages [start, stop) of a PDF, with an empty string for unreadable pages"""
+    pdf_reader = PdfReader(path)
+    texts = []
+
+    for page_num in range(start, stop):
+        try:
+            texts.append(pdf_reader.pages[page_num].extract_text() or "")
+        except Exception:
+            texts.append("")
+
+    return texts
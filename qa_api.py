@@ -0,0 +1,177 @@
+# Interface of the question answering backend, shared by core.py, service.py and the Streamlit app:
+# the answer stream and error types, plus the in-process and HTTP backends. Nothing heavy is imported
+# here, so a UI that talks to the HTTP service never loads FAISS, LangChain or the Google clients.
+import json
+import time
+import hashlib
+import threading
+import requests
+
+class IngestionError(Exception):
+    """Raised when the uploaded files yield no text chunks to index"""
+
+class EmbeddingError(Exception):
+    """Raised when the chunks of the uploaded files could not be embedded"""
+
+def compute_upload_key(files):
+    """Identify a set of uploaded files by their names and contents alone, to notice unchanged uploads"""
+    hasher = hashlib.sha256()
+    for name, digest in sorted((file.name, hashlib.sha256(file.getvalue()).hexdigest()) for file in files):
+        hasher.update(f"{name}:{digest}\n".encode("utf-8"))
+    return hasher.hexdigest()
+
+class AnswerStream:
+    """Iterable over the pieces of an answer as they are generated, for st.write_stream
+
+    Once iteration ends, answer holds the complete text to keep in the chat history, and
+    citations the files and pages it was drawn from.
+    """
+    
+    def __init__(self, pieces, started=None, citations=""):
+        self._pieces = pieces  # Generator of text pieces that returns the complete answer
+        self.started = started or time.perf_counter()
+        self.first_piece_seconds = None
+        self.timings = {}  # Seconds spent in each step before the answer started
+        self.speculated = False  # Whether the fallback answer was started alongside the primary one
+        self.winner = "primary"  # Which answer was kept: "primary" or "fallback"
+        self.context_tokens = None  # (retrieved, sent) prompt tokens of the first answer's context
+        self.reranked = None  # Whether the reranker finished in time, or None if it didn't run
+        self.cancelled = threading.Event()  # Set once the answer is finished or no longer wanted
+        self.answer = ""
+        self.citations = citations  # e.g. "📑 Sources: a.pdf (p. 2, 3)", or "" when there are none
+    
+    @classmethod
+    def of_text(cls, text, started=None, citations=""):
+        def pieces():
+            yield text
+            return text
+        return cls(pieces(), started, citations)
+    
+    def __iter__(self):
+        while True:
+            try:
+                piece = next(self._pieces)
+            except StopIteration as done:
+                self.answer = done.value or ""
+                return
+            if self.first_piece_seconds is None:
+                self.first_piece_seconds = time.perf_counter() - self.started
+            yield piece
+    
+    def cancel(self):
+        """Stop generating, e.g. when the reader went away; any speculative answer stops too"""
+        self.cancelled.set()
+
+class LocalBackend:
+    """Ingestion and answers computed in this process by the headless core"""
+    
+    def __init__(self):
+        # The core loads FAISS, LangChain and the Google clients, so it is only imported when used
+        import core
+        self._core = core
+    
+    def settings(self):
+        return self._core.backend_settings()
+    
+    def ingest(self, files, base_key=None, on_progress=None):
+        return self._core.ingest(files, base_key, on_progress)
+    
+    def describe_corpus(self, corpus_key):
+        return self._core.describe_corpus(corpus_key)
+    
+    def start_answer(self, user_input, corpus_key, scope=None, reuse_answers=False, holder=None):
+        return self._core.start_answer(user_input, corpus_key, scope, reuse_answers, holder)
+    
+    def acquire(self, corpus_key, holder):
+        self._core.get_index_store().acquire(corpus_key, holder)
+    
+    def release(self, corpus_key, holder):
+        self._core.get_index_store().release(corpus_key, holder)
+
+class ServiceClient:
+    """The same operations as LocalBackend, sent to the QA service over HTTP"""
+    
+    def __init__(self, base_url, timeout=300):
+        self.base_url = base_url
+        self.timeout = timeout
+    
+    def settings(self):
+        response = requests.get(f"{self.base_url}/settings", timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+    
+    def _post(self, path, **kwargs):
+        response = requests.post(f"{self.base_url}{path}", timeout=self.timeout, **kwargs)
+        response.raise_for_status()
+        return response
+    
+    def ingest(self, files, base_key=None, on_progress=None):
+        if on_progress is not None:
+            on_progress("Indexing on the QA service...")
+        response = requests.post(
+            f"{self.base_url}/ingest",
+            files=[("files", (file.name, file.getvalue(), "application/pdf")) for file in files],
+            data={"base_key": base_key} if base_key else {},
+            timeout=self.timeout
+        )
+        # The service reports PDFs without usable text and embedding failures with these codes
+        if response.status_code == 422:
+            raise IngestionError(response.json()["detail"])
+        if response.status_code == 502:
+            raise EmbeddingError(response.json()["detail"])
+        response.raise_for_status()
+        return response.json()
+    
+    def describe_corpus(self, corpus_key):
+        response = requests.get(f"{self.base_url}/corpora/{corpus_key}", timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+    
+    def start_answer(self, user_input, corpus_key, scope=None, reuse_answers=False, holder=None):
+        started = time.perf_counter()
+        file_keys, pages = scope if scope is not None else (None, None)
+        payload = {
+            "question": user_input,
+            "corpus_key": corpus_key,
+            "scope": {"file_keys": file_keys, "pages": pages} if scope is not None else None,
+            "reuse_answers": reuse_answers,
+            "holder": holder,
+        }
+        try:
+            response = self._post("/answer/stream", json=payload, stream=True)
+        except requests.RequestException as service_error:
+            return AnswerStream.of_text(f"❌ QA service error: {str(service_error)}", started)
+        
+        def pieces():
+            # JSON lines: {"text": piece} while generating, then {"answer", "citations", "stats"} once complete
+            try:
+                with response:
+                    for line in response.iter_lines():
+                        if not line:
+                            continue
+                        event = json.loads(line)
+                        if "text" in event:
+                            yield event["text"]
+                            continue
+                        stats = event["stats"]
+                        stream.timings = stats["timings"]
+                        stream.context_tokens = tuple(stats["context_tokens"]) if stats["context_tokens"] else None
+                        stream.reranked = stats["reranked"]
+                        stream.speculated = stats["speculated"]
+                        stream.winner = stats["winner"]
+                        stream.citations = event.get("citations", "")
+                        return event["answer"]
+                message = "❌ QA service error: the answer ended early"
+            except requests.RequestException as service_error:
+                message = f"❌ QA service error: {str(service_error)}"
+            yield message
+            return message
+        
+        stream = AnswerStream(pieces(), started)
+        return stream
+    
+    def acquire(self, corpus_key, holder):
+        self._post(f"/corpora/{corpus_key}/acquire", json={"holder": holder})
+    
+    def release(self, corpus_key, holder):
+        self._post(f"/corpora/{corpus_key}/release", json={"holder": holder})
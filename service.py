@@ -0,0 +1,195 @@
+# HTTP service for document ingestion and question answering, running the headless core (core.py).
+# Start with: uvicorn service:app --host 0.0.0.0 --port 8000 --workers 4
+import os
+import re
+import json
+import asyncio
+from contextlib import asynccontextmanager
+from typing import List, Optional
+from fastapi import FastAPI, File, Form, HTTPException, UploadFile
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+from core import (
+    UploadedPDF, IngestionError, EmbeddingError,
+    ingest, describe_corpus, start_answer, process_user_message, backend_settings, get_index_store,
+)
+
+# Requests beyond these limits wait in a queue, and are turned away once they waited too long
+QA_MAX_CONCURRENT_QUERIES = int(os.getenv("QA_MAX_CONCURRENT_QUERIES", "8"))
+QA_MAX_CONCURRENT_INGESTS = int(os.getenv("QA_MAX_CONCURRENT_INGESTS", "2"))
+QA_QUEUE_TIMEOUT_SECONDS = float(os.getenv("QA_QUEUE_TIMEOUT_SECONDS", "30"))
+
+CORPUS_KEY_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+class AnswerScope(BaseModel):
+    file_keys: Optional[List[str]] = None
+    pages: Optional[List[int]] = None  # [first page, last page]
+
+class AnswerRequest(BaseModel):
+    question: str
+    corpus_key: str
+    scope: Optional[AnswerScope] = None
+    reuse_answers: bool = False
+    holder: Optional[str] = None
+
+class HolderRequest(BaseModel):
+    holder: str
+
+@asynccontextmanager
+async def lifespan(app):
+    # Semaphores belong to the running event loop, so they are created once it is up
+    app.state.query_slots = asyncio.Semaphore(QA_MAX_CONCURRENT_QUERIES)
+    app.state.ingest_slots = asyncio.Semaphore(QA_MAX_CONCURRENT_INGESTS)
+    yield
+
+app = FastAPI(title="AI PDF Chatbot", lifespan=lifespan)
+
+async def acquire_slot(semaphore):
+    """Wait for one of a limited number of concurrent request slots, or fail with 503 when none frees up"""
+    try:
+        await asyncio.wait_for(semaphore.acquire(), QA_QUEUE_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail="Server busy, please retry", headers={"Retry-After": "5"})
+
+@asynccontextmanager
+async def slot(semaphore):
+    """Hold a request slot for the duration of the block"""
+    await acquire_slot(semaphore)
+    try:
+        yield
+    finally:
+        semaphore.release()
+
+class ClosingStreamingResponse(StreamingResponse):
+    """Streaming response that runs on_close however it ends: finished, failed, or the client went away
+
+    Unlike a background task or a finally block in the body generator, this also runs when
+    sending fails before the body is first read.
+    """
+    
+    def __init__(self, content, on_close, **kwargs):
+        super().__init__(content, **kwargs)
+        self.on_close = on_close
+    
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.on_close()
+
+def check_corpus_key(corpus_key):
+    """Reject keys that aren't ingestion keys, so they can't name paths outside the index store"""
+    if not CORPUS_KEY_PATTERN.match(corpus_key):
+        raise HTTPException(status_code=400, detail="Invalid corpus key")
+    if not get_index_store().exists(corpus_key):
+        raise HTTPException(status_code=404, detail="Corpus not found")
+
+def answer_scope(request):
+    """The (file keys, page range) tuple start_answer expects, or None to search everything"""
+    if request.scope is None:
+        return None
+    file_keys = tuple(request.scope.file_keys) if request.scope.file_keys else None
+    pages = tuple(request.scope.pages) if request.scope.pages else None
+    if pages is not None and len(pages) != 2:
+        raise HTTPException(status_code=422, detail="pages must be [first page, last page]")
+    if file_keys is None and pages is None:
+        return None
+    return (file_keys, pages)
+
+def stream_stats(stream):
+    """Timings and retrieval statistics of a finished AnswerStream, as JSON-serializable values"""
+    return {
+        "first_token": stream.first_piece_seconds,
+        "timings": stream.timings,
+        "context_tokens": stream.context_tokens,
+        "reranked": stream.reranked,
+        "speculated": stream.speculated,
+        "winner": stream.winner,
+    }
+
+@app.get("/health")
+async def health():
+    return {"status": "ok"}
+
+@app.get("/settings")
+async def settings():
+    """Embedding backend, reranker and answer cache defaults, for clients to display"""
+    return backend_settings()
+
+@app.post("/ingest")
+async def ingest_files(
+    files: List[UploadFile] = File(...),
+    base_key: Optional[str] = Form(None),
+):
+    """Index uploaded PDFs (incrementally from base_key when given) and return the corpus key"""
+    if base_key is not None and not CORPUS_KEY_PATTERN.match(base_key):
+        raise HTTPException(status_code=400, detail="Invalid base key")
+    pdfs = [UploadedPDF(upload.filename, await upload.read()) for upload in files]
+    async with slot(app.state.ingest_slots):
+        try:
+            result = await run_in_threadpool(ingest, pdfs, base_key)
+        except IngestionError as error:
+            raise HTTPException(status_code=422, detail=str(error))
+        except EmbeddingError as error:
+            # The embedding API (or local model) failed, not the request
+            raise HTTPException(status_code=502, detail=str(error))
+    return result
+
+@app.get("/corpora/{corpus_key}")
+async def get_corpus(corpus_key: str):
+    """Files, page range and index report of a corpus, for building search scopes"""
+    check_corpus_key(corpus_key)
+    return await run_in_threadpool(describe_corpus, corpus_key)
+
+@app.post("/corpora/{corpus_key}/acquire")
+async def acquire_corpus(corpus_key: str, request: HolderRequest):
+    check_corpus_key(corpus_key)
+    get_index_store().acquire(corpus_key, request.holder)
+    return {"corpus_key": corpus_key}
+
+@app.post("/corpora/{corpus_key}/release")
+async def release_corpus(corpus_key: str, request: HolderRequest):
+    if not CORPUS_KEY_PATTERN.match(corpus_key):
+        raise HTTPException(status_code=400, detail="Invalid corpus key")
+    get_index_store().release(corpus_key, request.holder)
+    return {"corpus_key": corpus_key}
+
+@app.post("/answer")
+async def answer(request: AnswerRequest):
+    """Answer a question in one piece"""
+    check_corpus_key(request.corpus_key)
+    scope = answer_scope(request)
+    async with slot(app.state.query_slots):
+        stream = await run_in_threadpool(
+            process_user_message, request.question, request.corpus_key, scope, request.reuse_answers, request.holder
+        )
+    return {"answer": stream.answer, "citations": stream.citations, "stats": stream_stats(stream)}
+
+@app.post("/answer/stream")
+async def answer_stream(request: AnswerRequest):
+    """Stream an answer as JSON lines: {"text": piece} as generated, then {"answer", "citations", "stats"} once complete"""
+    check_corpus_key(request.corpus_key)
+    scope = answer_scope(request)
+    # The slot is held until the last piece is sent, not just until retrieval is done
+    query_slots = app.state.query_slots
+    await acquire_slot(query_slots)
+    try:
+        stream = await run_in_threadpool(
+            start_answer, request.question, request.corpus_key, scope, request.reuse_answers, request.holder
+        )
+    except BaseException:
+        query_slots.release()
+        raise
+    
+    def close():
+        # Stops generation (and any speculative answer) if the client left early
+        stream.cancel()
+        query_slots.release()
+    
+    async def events():
+        async for piece in iterate_in_threadpool(iter(stream)):
+            yield json.dumps({"text": piece}) + "\n"
+        yield json.dumps({"answer": stream.answer, "citations": stream.citations, "stats": stream_stats(stream)}) + "\n"
+    
+    return ClosingStreamingResponse(events(), close, media_type="application/x-ndjson")
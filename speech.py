@@ -0,0 +1,177 @@
+# Text-to-speech synthesis with a size-bounded on-disk audio cache.
+# Kept outside new.py so it can be imported and tested without running the Streamlit app.
+import os
+import io
+import re
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from gtts import gTTS
+
+TTS_CHUNK_CHARS = 500  # Sentences are grouped into pieces of about this length, synthesized concurrently
+TTS_MAX_WORKERS = 4
+
+def gtts_synthesize(text, language_code):
+    """Synthesize MP3 audio for a piece of text with gTTS, in memory"""
+    buffer = io.BytesIO()
+    gTTS(text=text, lang=language_code).write_to_fp(buffer)
+    return buffer.getvalue()
+
+SENTENCE_END_PATTERN = re.compile(r"(?<=[.!?。！？])\s+")
+
+def split_speech_text(text, max_chars=TTS_CHUNK_CHARS):
+    """Split text at sentence ends into pieces of at most about max_chars characters"""
+    pieces = []
+    current = ""
+    for sentence in SENTENCE_END_PATTERN.split(text.strip()):
+        if current and len(current) + 1 + len(sentence) > max_chars:
+            pieces.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}" if current else sentence
+    if current:
+        pieces.append(current)
+    return pieces
+
+class AudioCache:
+    """Size-bounded directory of synthesized audio files, evicting the least recently used first"""
+    
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        # Counts the files left by earlier runs, trimming them if the budget shrank
+        self._total_bytes = 0
+        self._evict()
+    
+    def _path(self, key):
+        return os.path.join(self.root, f"{key}.mp3")
+    
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as audio_file:
+                data = audio_file.read()
+            # The modification time doubles as the last-used time for eviction
+            os.utime(path)
+            return data
+        except OSError:
+            return None
+    
+    def put(self, key, data):
+        # Write to a temporary file and rename, so readers never see a partial file
+        path = self._path(key)
+        fd, temp_path = tempfile.mkstemp(prefix=".", suffix=".mp3", dir=self.root)
+        with self._lock:
+            try:
+                with os.fdopen(fd, "wb") as audio_file:
+                    audio_file.write(data)
+                # Listen and prefetch may both synthesize the same answer; the file replaced stops counting
+                try:
+                    replaced = os.stat(path).st_size
+                except OSError:
+                    replaced = 0
+                os.replace(temp_path, path)
+            except OSError:
+                os.remove(temp_path)
+                raise
+            self._total_bytes += len(data) - replaced
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+    
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.root):
+            if name.startswith("."):
+                # Audio still being written by another thread
+                continue
+            try:
+                stat = os.stat(os.path.join(self.root, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, name, stat.st_size))
+        self._total_bytes = sum(size for _, _, size in entries)
+        for _, name, size in sorted(entries):
+            if self._total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.root, name))
+            except OSError:
+                continue
+            self._total_bytes -= size
+
+class SpeechPrefetch:
+    """Handle on background synthesis of one text in one language"""
+    
+    def __init__(self, text, language_code, future, cancelled):
+        self.text = text
+        self.language_code = language_code
+        self.future = future  # Resolves to the MP3 bytes, or None if cancelled
+        self.cancelled = cancelled
+    
+    def matches(self, text, language_code):
+        return self.text == text and self.language_code == language_code and not self.cancelled.is_set()
+    
+    def cancel(self):
+        self.cancelled.set()
+        self.future.cancel()
+
+class SpeechSynthesizer:
+    """Text-to-speech with an audio cache keyed by (text hash, language)
+
+    Long texts are split at sentence ends and the pieces are synthesized concurrently;
+    MP3 frames can be concatenated, so the pieces are simply joined in order.
+    """
+    
+    def __init__(self, cache, synthesize=gtts_synthesize, max_workers=TTS_MAX_WORKERS):
+        self.cache = cache
+        self.synthesize = synthesize  # (text, language code) -> MP3 bytes
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        # Prefetch jobs wait on piece futures, so they get their own pool to avoid starving it
+        self._background = ThreadPoolExecutor(max_workers=2)
+    
+    @staticmethod
+    def cache_key(text, language_code):
+        return hashlib.sha256(f"{language_code}\0{text}".encode("utf-8")).hexdigest()
+    
+    def iter_audio(self, text, language_code):
+        """Yield the audio of each piece of text in order, as soon as it and all before it are ready"""
+        futures = [self._executor.submit(self.synthesize, piece, language_code) for piece in split_speech_text(text)]
+        try:
+            for future in futures:
+                yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+    
+    def audio_for(self, text, language_code):
+        """Return the complete MP3 audio for text, from the cache when possible"""
+        key = self.cache_key(text, language_code)
+        audio = self.cache.get(key)
+        if audio is None:
+            audio = b"".join(self.iter_audio(text, language_code))
+            self.cache.put(key, audio)
+        return audio
+    
+    def prefetch(self, text, language_code):
+        """Start synthesizing text into the cache in the background"""
+        cancelled = threading.Event()
+        future = self._background.submit(self._prefetch, text, language_code, cancelled)
+        return SpeechPrefetch(text, language_code, future, cancelled)
+    
+    def _prefetch(self, text, language_code, cancelled):
+        key = self.cache_key(text, language_code)
+        audio = self.cache.get(key)
+        if audio is not None:
+            return audio
+        pieces = []
+        for piece in self.iter_audio(text, language_code):
+            # Leaving the loop closes iter_audio, which cancels the pieces not started yet
+            if cancelled.is_set():
+                return None
+            pieces.append(piece)
+        audio = b"".join(pieces)
+        self.cache.put(key, audio)
+        return audio
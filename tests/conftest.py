@@ -0,0 +1,55 @@
+import os
+import sys
+
+import pytest
+
+# The modules under test live at the repository root, next to the Streamlit script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_pdf(lines):
+    """A one-page PDF showing the given lines of text in Helvetica"""
+    content = "BT /F1 12 Tf 72 720 Td " + " ".join(f"({line}) Tj 0 -16 Td" for line in lines) + " ET"
+    objects = [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        "<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R "
+        "/Resources << /Font << /F1 5 0 R >> >> >>",
+        f"<< /Length {len(content)} >>\nstream\n{content}\nendstream",
+        "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    data = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(data))
+        data += f"{number} 0 obj\n{body}\nendobj\n".encode()
+    xref = len(data)
+    data += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    data += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode()
+    data += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF".encode()
+    return data
+
+
+def upload(name, topic, lines=40):
+    """An uploaded one-page PDF about the topic"""
+    # Imported here so tests of the UI helpers and the client don't load the core
+    import core
+    return core.UploadedPDF(name, make_pdf(
+        [f"The {topic} manual covers part number {number} for {number + 2} years of use." for number in range(lines)]
+    ))
+
+
+@pytest.fixture
+def index_store(tmp_path, monkeypatch):
+    """A private index store, registry and embedding cache, with local hashing embeddings"""
+    import core
+    store = core.IndexStore(str(tmp_path / "indexes"), max_bytes=1 << 30)
+    registry = core.VectorStoreRegistry(max_bytes=1 << 30)
+    cache = core.EmbeddingCache(str(tmp_path / "embeddings.sqlite3"), max_bytes=1 << 30)
+    monkeypatch.setattr(core, "get_index_store", lambda: store)
+    monkeypatch.setattr(core, "get_vector_store_registry", lambda: registry)
+    monkeypatch.setattr(core, "get_embedding_cache", lambda: cache)
+    monkeypatch.setattr(core, "get_embeddings", lambda: core.HashingEmbeddings())
+    monkeypatch.setattr(core, "embedding_model_name", lambda: "hashing-test")
+    monkeypatch.setattr(core, "get_embedding_rate_limiter", lambda: None)
+    return store
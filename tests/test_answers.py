@@ -0,0 +1,33 @@
+import core
+from conftest import upload
+
+
+def answer(question, corpus_key, reuse_answers=False):
+    stream = core.start_answer(question, corpus_key, reuse_answers=reuse_answers)
+    pieces = list(stream)
+    return stream, "".join(pieces)
+
+
+def test_citations_are_kept_apart_from_the_answer(index_store, monkeypatch):
+    corpus_key = core.ingest([upload("a.pdf", "kettle")])["corpus_key"]
+    monkeypatch.setattr(core, "get_answer_chain", lambda: None)
+    monkeypatch.setattr(core, "stream_chain", lambda chain, docs, question: iter(["The kettle ", "lasts."]))
+
+    stream, streamed = answer("How long does the kettle last?", corpus_key)
+
+    assert streamed == stream.answer == "The kettle lasts."
+    assert stream.citations == "📑 Sources: a.pdf (p. 1)"
+
+
+def test_cached_answers_keep_their_citations(index_store, monkeypatch):
+    corpus_key = core.ingest([upload("a.pdf", "kettle")])["corpus_key"]
+    monkeypatch.setattr(core, "get_answer_cache", lambda cache=core.AnswerCache(10, 60, 0.9): cache)
+    monkeypatch.setattr(core, "get_answer_chain", lambda: None)
+    monkeypatch.setattr(core, "stream_chain", lambda chain, docs, question: iter(["The kettle lasts."]))
+    answer("How long does the kettle last?", corpus_key)
+    monkeypatch.setattr(core, "stream_chain", lambda chain, docs, question: iter(["Not from the cache."]))
+
+    stream, streamed = answer("How long does the kettle last?", corpus_key, reuse_answers=True)
+
+    assert streamed == "The kettle lasts."
+    assert stream.citations == "📑 Sources: a.pdf (p. 1)"
@@ -0,0 +1,162 @@
+import pytest
+
+import core
+from conftest import upload
+
+
+@pytest.fixture
+def extracted(monkeypatch):
+    """Names of the files whose pages were read"""
+    names = []
+    iter_pdf_pages = core.iter_pdf_pages
+
+    def recording_iter_pdf_pages(keyed_files, temp_dir):
+        names.extend(file.name for _, file in keyed_files)
+        return iter_pdf_pages(keyed_files, temp_dir)
+
+    monkeypatch.setattr(core, "iter_pdf_pages", recording_iter_pdf_pages)
+    return names
+
+
+@pytest.fixture
+def small_ann(monkeypatch):
+    """Approximate indexes for a few dozen chunks"""
+    monkeypatch.setattr(core, "CHUNK_SIZE", 200)
+    monkeypatch.setattr(core, "CHUNK_OVERLAP", 20)
+    monkeypatch.setattr(core, "ANN_MIN_TRAIN_VECTORS", 10)
+
+    def use(index_type):
+        monkeypatch.setattr(core, "ANN_INDEX_TYPE", index_type)
+    return use
+
+
+def published(store, corpus_key):
+    return core.get_vector_store_registry().get(store.path_for(corpus_key), core.get_embeddings())
+
+
+def chunk_texts(loaded_index):
+    vector_store = loaded_index.vector_store
+    return [vector_store.docstore.search(vector_store.index_to_docstore_id[position]).page_content
+            for position in range(vector_store.index.ntotal)]
+
+
+def test_new_corpus_is_registered_from_the_published_files(index_store):
+    files = [upload("a.pdf", "kettle"), upload("b.pdf", "toaster")]
+    result = core.ingest(files)
+
+    loaded_index = published(index_store, result["corpus_key"])
+    assert isinstance(loaded_index.vector_store.docstore, core.MappedDocstore)
+    texts = chunk_texts(loaded_index)
+    assert len(texts) == result["chunk_count"] > 2
+    assert any("kettle" in text for text in texts) and any("toaster" in text for text in texts)
+
+
+def test_incremental_update_keeps_texts_in_index_order(index_store):
+    first = core.ingest([upload("a.pdf", "kettle"), upload("b.pdf", "toaster")])
+    second = core.ingest([upload("b.pdf", "toaster"), upload("c.pdf", "blender")], base_key=first["corpus_key"])
+
+    texts = chunk_texts(published(index_store, second["corpus_key"]))
+    assert len(texts) == second["chunk_count"]
+    assert not any("kettle" in text for text in texts)
+    assert any("toaster" in text for text in texts) and any("blender" in text for text in texts)
+    # Each stored text is the one its vector was computed from
+    embeddings = core.get_embeddings()
+    vectors = published(index_store, second["corpus_key"]).vector_store.index.reconstruct_n(0, len(texts))
+    assert all(abs(vector - embeddings.embed_query(text)).max() < 1e-5 for vector, text in zip(vectors, texts))
+
+
+def assert_texts_match_vectors(loaded_index, expected_count):
+    texts = chunk_texts(loaded_index)
+    assert len(texts) == expected_count
+    embeddings = core.get_embeddings()
+    vectors = loaded_index.vector_store.index.reconstruct_n(0, len(texts))
+    assert all(abs(vector - embeddings.embed_query(text)).max() < 1e-5 for vector, text in zip(vectors, texts))
+    return texts
+
+
+def test_ivf_index_is_updated_in_place(index_store, extracted, small_ann):
+    small_ann("ivf_flat")
+    first = core.ingest([upload("a.pdf", "kettle", 120), upload("b.pdf", "toaster", 120)])
+    assert first["index_report"]["index_type"] == "ivf_flat"
+    extracted.clear()
+
+    second = core.ingest([upload("b.pdf", "toaster", 120), upload("c.pdf", "blender", 120)],
+                         base_key=first["corpus_key"])
+
+    assert extracted == ["c.pdf"]
+    assert second["index_report"]["index_type"] == "ivf_flat"
+    assert second["index_report"]["sweep"] == first["index_report"]["sweep"]
+    loaded_index = published(index_store, second["corpus_key"])
+    texts = assert_texts_match_vectors(loaded_index, second["chunk_count"])
+    assert not any("kettle" in text for text in texts)
+    hits = core.search_vectors(loaded_index, [core.get_embeddings().embed_query(texts[-1])], 1)
+    assert hits[0][0][0] == len(texts) - 1
+
+
+def test_hnsw_index_takes_new_files_in_place(index_store, extracted, small_ann):
+    small_ann("hnsw")
+    first = core.ingest([upload("a.pdf", "kettle", 120)])
+    extracted.clear()
+
+    second = core.ingest([upload("a.pdf", "kettle", 120), upload("b.pdf", "toaster", 120)],
+                         base_key=first["corpus_key"])
+
+    assert extracted == ["b.pdf"]
+    assert second["index_report"]["index_type"] == "hnsw"
+    assert_texts_match_vectors(published(index_store, second["corpus_key"]), second["chunk_count"])
+
+
+def test_removing_files_from_hnsw_rebuilds(index_store, extracted, small_ann):
+    small_ann("hnsw")
+    first = core.ingest([upload("a.pdf", "kettle", 120), upload("b.pdf", "toaster", 120)])
+    extracted.clear()
+
+    second = core.ingest([upload("b.pdf", "toaster", 120)], base_key=first["corpus_key"])
+
+    assert extracted == ["b.pdf"]
+    texts = assert_texts_match_vectors(published(index_store, second["corpus_key"]), second["chunk_count"])
+    assert not any("kettle" in text for text in texts)
+
+
+def test_outgrowing_the_flat_index_switches_type_in_place(index_store, extracted, small_ann, monkeypatch):
+    small_ann("auto")
+    first = core.ingest([upload("a.pdf", "kettle", 120)])
+    assert first["index_report"]["index_type"] == "flat"
+    monkeypatch.setattr(core, "FLAT_INDEX_MAX_VECTORS", first["chunk_count"] + 1)
+    extracted.clear()
+
+    second = core.ingest([upload("a.pdf", "kettle", 120), upload("b.pdf", "toaster", 120)],
+                         base_key=first["corpus_key"])
+
+    assert extracted == ["b.pdf"]
+    assert second["index_report"]["index_type"] == "hnsw"
+    assert_texts_match_vectors(published(index_store, second["corpus_key"]), second["chunk_count"])
+
+
+def test_ivf_pq_is_rebuilt_only_when_shrinking_out_of_its_type(monkeypatch):
+    monkeypatch.setattr(core, "ANN_INDEX_TYPE", "auto")
+    large = core.IVF_FLAT_INDEX_MAX_VECTORS
+    assert core.can_update_in_place("ivf_pq", large, removing=True)
+    assert not core.can_update_in_place("ivf_pq", large - 1, removing=True)
+    assert core.can_update_in_place("ivf_flat", 10, removing=True)
+    assert not core.can_update_in_place("hnsw", large, removing=True)
+    assert core.can_update_in_place("hnsw", large, removing=False)
+
+
+def test_only_embedding_failures_are_reported_as_embedding_errors(index_store, monkeypatch):
+    class BrokenEmbeddings(core.HashingEmbeddings):
+        def embed_documents(self, texts):
+            raise ValueError("API key not valid")
+
+    monkeypatch.setattr(core, "get_embeddings", lambda: BrokenEmbeddings())
+    with pytest.raises(core.EmbeddingError, match="API key not valid"):
+        core.ingest([upload("a.pdf", "kettle")])
+
+
+def test_other_failures_surface_as_themselves(index_store, monkeypatch):
+    def full_disk(*args):
+        raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(core.VectorSpill, "add", full_disk)
+    with pytest.raises(OSError, match="No space left"):
+        core.ingest([upload("a.pdf", "kettle")])
@@ -0,0 +1,50 @@
+import core
+
+
+def stored_bytes(cache):
+    (total,) = cache._conn.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()
+    return total
+
+
+def test_running_total_tracks_inserts_replacements_and_duplicates(tmp_path):
+    cache = core.EmbeddingCache(str(tmp_path / "cache.sqlite"), max_bytes=1 << 20)
+    cache.put_many("m", ["a", "b"], [[1.0, 2.0], [3.0, 4.0]])
+    # Replacing a row with a longer vector, and the same text twice in one batch
+    cache.put_many("m", ["a", "c", "c"], [[1.0, 2.0, 3.0], [5.0], [6.0]])
+    assert cache.stored_bytes() == stored_bytes(cache) == 4 * (3 + 2 + 1)
+    assert cache.get_many("m", ["c"]) == [[6.0]]
+
+
+def test_eviction_keeps_total_within_budget(tmp_path):
+    cache = core.EmbeddingCache(str(tmp_path / "cache.sqlite"), max_bytes=400)
+    for batch in range(10):
+        cache.put_many("m", [f"text {batch} {i}" for i in range(5)], [[float(i)] * 4 for i in range(5)])
+        assert cache.stored_bytes() == stored_bytes(cache) <= 400
+    # The most recently stored vectors survive
+    assert None not in cache.get_many("m", [f"text 9 {i}" for i in range(5)])
+
+
+def test_processes_sharing_the_file_share_the_budget(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    caches = [core.EmbeddingCache(path, max_bytes=400), core.EmbeddingCache(path, max_bytes=400)]
+    for batch in range(10):
+        for number, cache in enumerate(caches):
+            cache.put_many("m", [f"cache {number} text {batch} {i}" for i in range(5)], [[float(i)] * 4 for i in range(5)])
+            assert cache.stored_bytes() == stored_bytes(cache) <= 400
+
+
+def test_total_is_summed_once_when_created(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    core.EmbeddingCache(path, max_bytes=1 << 20).put_many("m", ["a", "b"], [[1.0], [2.0, 3.0]])
+    # A cache file from before the total was stored
+    cache = core.EmbeddingCache(path, max_bytes=1 << 20)
+    cache._conn.execute("DROP TABLE embedding_usage")
+    cache._conn.commit()
+    cache = core.EmbeddingCache(path, max_bytes=1 << 20)
+    assert cache.stored_bytes() == 12
+
+    statements = []
+    cache._conn.set_trace_callback(statements.append)
+    cache.put_many("m", ["c"], [[4.0]])
+    assert cache.stored_bytes() == 16
+    assert not [statement for statement in statements if "SUM(" in statement]
@@ -0,0 +1,123 @@
+import functools
+import threading
+import time
+
+import pytest
+from langchain_core.embeddings import Embeddings
+
+import core
+
+
+class RateLimitError(Exception):
+    status_code = 429
+
+
+class FakeEmbeddings(Embeddings):
+    """Local embedder that sleeps on every call, fails on a schedule and records its concurrency
+
+    The first fail_attempts attempts at every fail_every-th batch fail; later retries of it succeed.
+    """
+
+    def __init__(self, latency=0.002, fail_every=0, fail_attempts=1,
+                 error_factory=lambda: RateLimitError("429 Too Many Requests")):
+        self.latency = latency
+        self.fail_every = fail_every
+        self.fail_attempts = fail_attempts
+        self.error_factory = error_factory
+        self.calls = 0
+        self.batch_numbers = {}  # first text of a batch -> its number, counting from 1
+        self.attempts = {}  # first text of a batch -> attempts so far
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def vector(text):
+        return [float(len(text)), float(sum(map(ord, text)) % 97), 1.0, 0.0]
+
+    def embed_documents(self, texts):
+        with self._lock:
+            self.calls += 1
+            batch_number = self.batch_numbers.setdefault(texts[0], len(self.batch_numbers) + 1)
+            attempt = self.attempts[texts[0]] = self.attempts.get(texts[0], 0) + 1
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            time.sleep(self.latency)
+            if self.fail_every and attempt <= self.fail_attempts and batch_number % self.fail_every == 0:
+                raise self.error_factory()
+            return [self.vector(text) for text in texts]
+        finally:
+            with self._lock:
+                self.active -= 1
+
+    def embed_query(self, text):
+        return self.vector(text)
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(core, "embed_batch_with_retry",
+                        functools.partial(core.embed_batch_with_retry, base_delay=0.001))
+
+
+def make_chunks(count):
+    return [(f"chunk-{number}", f"text of chunk {number}") for number in range(count)]
+
+
+def test_retries_succeed_and_every_id_lands_in_the_index():
+    embeddings = FakeEmbeddings(fail_every=3)
+    chunks = make_chunks(500)
+
+    vector_store = core.index_chunk_stream(iter(chunks), embeddings, None, model_name="fake",
+                                           batch_size=16, max_workers=4, max_pending=8)
+
+    assert vector_store.index.ntotal == len(chunks)
+    assert sorted(vector_store.index_to_docstore_id.values()) == sorted(cid for cid, _ in chunks)
+    position = {cid: pos for pos, cid in vector_store.index_to_docstore_id.items()}["chunk-123"]
+    assert vector_store.index.reconstruct(position).tolist() == FakeEmbeddings.vector("text of chunk 123")
+    assert embeddings.calls > len(chunks) // 16  # Some batches needed a retry
+
+
+def test_non_retryable_error_propagates_and_cancels_pending_batches():
+    embeddings = FakeEmbeddings(latency=0.01, fail_every=3, error_factory=lambda: ValueError("invalid request"))
+    total_batches = 100
+
+    with pytest.raises(core.EmbeddingError, match="invalid request") as raised:
+        core.index_chunk_stream(iter(make_chunks(total_batches * 4)), embeddings, None, model_name="fake",
+                                batch_size=4, max_workers=2, max_pending=4)
+
+    assert isinstance(raised.value.__cause__, ValueError)
+    # Batches still queued when the error surfaced were never sent
+    assert embeddings.calls < total_batches // 2
+
+
+def test_retries_give_up_after_max_retries():
+    embeddings = FakeEmbeddings(fail_every=1, fail_attempts=10)
+
+    with pytest.raises(core.EmbeddingError) as raised:
+        core.embed_batch_with_retry(embeddings, ["a", "b"], None, max_retries=2, base_delay=0.001)
+    assert isinstance(raised.value.__cause__, RateLimitError)
+    assert embeddings.calls == 3
+
+
+def test_concurrency_stays_within_max_workers():
+    embeddings = FakeEmbeddings(latency=0.01)
+
+    core.index_chunk_stream(iter(make_chunks(200)), embeddings, None, model_name="fake",
+                            batch_size=4, max_workers=3, max_pending=12)
+
+    assert 1 < embeddings.max_active <= 3
+
+
+def test_rate_limiter_spaces_out_requests():
+    rate_limiter = core.TokenBucket(rate_per_second=50, capacity=1)
+    embeddings = FakeEmbeddings(latency=0)
+
+    started = time.monotonic()
+    core.index_chunk_stream(iter(make_chunks(44)), embeddings, rate_limiter, model_name="fake",
+                            batch_size=4, max_workers=4)
+
+    # 11 requests at 50 per second with a single token of burst: at least 10 waits of 20 ms
+    assert time.monotonic() - started >= 0.19
+    assert embeddings.calls == 11
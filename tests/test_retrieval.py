@@ -0,0 +1,37 @@
+import faiss
+import numpy as np
+
+import core
+
+
+def flat_index(vectors):
+    index = faiss.IndexFlatL2(len(vectors[0]))
+    index.add(np.array(vectors, dtype="float32"))
+    return index
+
+
+def test_zero_vectors_are_not_similar_to_anything():
+    index = flat_index([[0.0, 0.0, 0.0], [0.0, 0.0, 0.0]])
+    assert core.top_cosine_similarity(index, [0.0, 0.0, 0.0], [0, 1]) == 0.0
+    assert core.top_cosine_similarity(index, [1.0, 0.0, 0.0], [0, 1]) == 0.0
+
+
+def test_zero_query_has_no_similarity():
+    index = flat_index([[1.0, 0.0, 0.0]])
+    assert core.top_cosine_similarity(index, [0.0, 0.0, 0.0], [0]) == 0.0
+
+
+def test_best_cosine_wins_over_nearest_zero_vector():
+    # The zero vector is nearer in L2 (distance 1) than the unit vector at cosine 0.4 (distance 1.2)
+    other = [0.4, np.sqrt(1 - 0.4 ** 2), 0.0]
+    index = flat_index([[0.0, 0.0, 0.0], other])
+    assert abs(core.top_cosine_similarity(index, [1.0, 0.0, 0.0], [0, 1]) - 0.4) < 1e-6
+
+
+def test_unscaled_vectors_use_their_direction():
+    index = flat_index([[3.0, 4.0, 0.0]])
+    assert abs(core.top_cosine_similarity(index, [2.0, 0.0, 0.0], [0]) - 0.6) < 1e-6
+
+
+def test_empty_result_has_no_similarity():
+    assert core.top_cosine_similarity(flat_index([[1.0, 0.0]]), [1.0, 0.0], []) == 0.0
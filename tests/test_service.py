@@ -0,0 +1,89 @@
+import asyncio
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+from starlette.requests import ClientDisconnect
+
+import core
+import service
+
+CORPUS_KEY = "0" * 64
+started_streams = []
+
+
+def fake_start_answer(question, corpus_key, scope=None, reuse_answers=False, holder=None):
+    if question == "fail":
+        raise RuntimeError("retrieval failed")
+    stream = core.AnswerStream.of_text(f"answer to {question}", citations="📑 Sources: a.pdf (p. 1)")
+    started_streams.append(stream)
+    return stream
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(service, "start_answer", fake_start_answer)
+    monkeypatch.setattr(core, "start_answer", fake_start_answer)
+    monkeypatch.setattr(service, "check_corpus_key", lambda corpus_key: None)
+    monkeypatch.setattr(service, "QA_MAX_CONCURRENT_QUERIES", 2)
+    monkeypatch.setattr(service, "QA_QUEUE_TIMEOUT_SECONDS", 0.05)
+    with TestClient(service.app, raise_server_exceptions=False) as test_client:
+        yield test_client
+
+
+def test_streamed_answers_give_their_slots_back(client):
+    for number in range(5):
+        response = client.post("/answer/stream", json={"question": f"q{number}", "corpus_key": CORPUS_KEY})
+        events = [json.loads(line) for line in response.text.splitlines()]
+        assert events[0] == {"text": f"answer to q{number}"}
+        assert events[-1]["answer"] == f"answer to q{number}"
+        assert events[-1]["citations"] == "📑 Sources: a.pdf (p. 1)"
+
+    assert service.app.state.query_slots._value == 2
+    assert all(stream.cancelled.is_set() for stream in started_streams)
+
+
+def test_whole_answers_come_with_citations_and_stats(client):
+    response = client.post("/answer", json={"question": "q", "corpus_key": CORPUS_KEY})
+
+    body = response.json()
+    assert body["answer"] == "answer to q"
+    assert body["citations"] == "📑 Sources: a.pdf (p. 1)"
+    assert "timings" in body["stats"]
+    assert service.app.state.query_slots._value == 2
+
+
+def test_failed_answers_give_their_slots_back(client):
+    for _ in range(3):
+        assert client.post("/answer/stream", json={"question": "fail", "corpus_key": CORPUS_KEY}).status_code == 500
+
+    assert service.app.state.query_slots._value == 2
+
+
+def test_requests_beyond_the_limit_are_turned_away(client):
+    query_slots = service.app.state.query_slots
+    query_slots._value = 0  # Every slot taken
+
+    response = client.post("/answer", json={"question": "q", "corpus_key": CORPUS_KEY})
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "5"
+
+
+def test_closing_response_runs_on_close_when_sending_fails():
+    closed = []
+
+    async def body():
+        yield "never read"
+
+    async def failing_send(message):
+        raise OSError("connection reset")
+
+    async def receive():
+        return {"type": "http.request", "body": b""}
+
+    response = service.ClosingStreamingResponse(body(), lambda: closed.append(True))
+    scope = {"type": "http", "asgi": {"spec_version": "2.4"}}
+    with pytest.raises(ClientDisconnect):
+        asyncio.run(response(scope, receive, failing_send))
+    assert closed == [True]
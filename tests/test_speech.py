@@ -0,0 +1,124 @@
+import os
+import random
+import threading
+import time
+
+from speech import AudioCache, SpeechSynthesizer, split_speech_text
+
+
+class FakeSynthesizer:
+    """Stand-in for gTTS that returns the text as bytes, finishing pieces in random order"""
+
+    def __init__(self):
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __call__(self, text, language_code):
+        with self._lock:
+            self.calls.append(text)
+        time.sleep(random.uniform(0, 0.01))
+        return f"<{language_code}:{text}>".encode("utf-8")
+
+
+LONG_TEXT = " ".join(f"Sentence number {number} is here." for number in range(60))
+
+
+def test_split_keeps_order_and_respects_max_chars():
+    pieces = split_speech_text(LONG_TEXT, max_chars=100)
+
+    assert len(pieces) > 1
+    assert " ".join(pieces) == LONG_TEXT
+    assert all(len(piece) <= 100 for piece in pieces)
+
+
+def test_pieces_are_concatenated_in_order(tmp_path):
+    synthesize = FakeSynthesizer()
+    synthesizer = SpeechSynthesizer(AudioCache(str(tmp_path), 10_000_000), synthesize, max_workers=4)
+
+    audio = synthesizer.audio_for(LONG_TEXT, "en")
+
+    expected = b"".join(f"<en:{piece}>".encode("utf-8") for piece in split_speech_text(LONG_TEXT))
+    assert audio == expected
+    assert len(synthesize.calls) == len(split_speech_text(LONG_TEXT))
+
+
+def test_cache_hits_skip_synthesis(tmp_path):
+    synthesize = FakeSynthesizer()
+    synthesizer = SpeechSynthesizer(AudioCache(str(tmp_path), 10_000_000), synthesize)
+
+    first = synthesizer.audio_for("Hello there.", "en")
+    calls = len(synthesize.calls)
+    assert synthesizer.audio_for("Hello there.", "en") == first
+    assert len(synthesize.calls) == calls
+
+    # A new cache over the same directory (another process or a restart) hits too
+    restarted = SpeechSynthesizer(AudioCache(str(tmp_path), 10_000_000), synthesize)
+    assert restarted.audio_for("Hello there.", "en") == first
+    assert len(synthesize.calls) == calls
+
+    # Another language is another entry
+    synthesizer.audio_for("Hello there.", "fr")
+    assert len(synthesize.calls) == calls + 1
+
+
+def test_eviction_keeps_the_cache_under_max_bytes(tmp_path):
+    cache = AudioCache(str(tmp_path), max_bytes=25)
+    for number, key in enumerate(["oldest", "middle"]):
+        cache.put(key, b"x" * 10)
+        os.utime(cache._path(key), (1000 + number, 1000 + number))
+    # Reading an entry makes it the most recently used
+    assert cache.get("oldest") == b"x" * 10
+
+    cache.put("newest", b"x" * 10)
+
+    assert cache.get("middle") is None
+    assert cache.get("oldest") == b"x" * 10
+    assert cache.get("newest") == b"x" * 10
+    assert sum(os.path.getsize(tmp_path / name) for name in os.listdir(tmp_path)) <= 25
+
+
+def test_replacing_an_entry_counts_only_the_new_file(tmp_path, monkeypatch):
+    cache = AudioCache(str(tmp_path), max_bytes=35)
+    evictions = []
+    monkeypatch.setattr(cache, "_evict", lambda: evictions.append(cache._total_bytes))
+    cache.put("other", b"x" * 10)
+    for _ in range(5):
+        cache.put("answer", b"y" * 10)
+
+    assert cache._total_bytes == 20
+    assert evictions == []
+
+
+def test_existing_files_count_towards_the_budget(tmp_path):
+    AudioCache(str(tmp_path), max_bytes=100).put("left-over", b"x" * 40)
+
+    AudioCache(str(tmp_path), max_bytes=30)
+
+    assert os.listdir(tmp_path) == []
+
+
+def test_no_temporary_files_are_left_behind(tmp_path):
+    synthesizer = SpeechSynthesizer(AudioCache(str(tmp_path), 10_000_000), FakeSynthesizer())
+    threads = [threading.Thread(target=synthesizer.audio_for, args=(f"Text {number}.", "en")) for number in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    names = os.listdir(tmp_path)
+    assert len(names) == 8
+    assert not [name for name in names if name.startswith(".")]
+
+
+def test_prefetch_fills_the_cache(tmp_path):
+    synthesize = FakeSynthesizer()
+    synthesizer = SpeechSynthesizer(AudioCache(str(tmp_path), 10_000_000), synthesize)
+
+    prefetch = synthesizer.prefetch(LONG_TEXT, "en")
+
+    assert prefetch.matches(LONG_TEXT, "en")
+    assert not prefetch.matches(LONG_TEXT, "de")
+    audio = prefetch.future.result(timeout=5)
+    calls = len(synthesize.calls)
+    assert synthesizer.audio_for(LONG_TEXT, "en") == audio
+    assert len(synthesize.calls) == calls